@@ -0,0 +1,151 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+# Times conversions of a synthetic Takeout folder made by generate-synthetic-takeout.py, or of a given folder, and
+# appends the results to a JSON lines file so runs on different versions or settings can be compared.
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+CONVERTER = SCRIPT_DIR / "export-gvoice-takeout.py"
+GENERATOR = SCRIPT_DIR / "generate-synthetic-takeout.py"
+DEFAULT_RESULTS_FILENAME = "benchmark-results.jsonl"
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark export-gvoice-takeout.py. Options not listed here are passed to "
+                    "generate-synthetic-takeout.py to size the synthetic Takeout folder, for example "
+                    "--conversations 5000 --messages 50 --media-kb 256.")
+    parser.add_argument("--input", help="benchmark this Takeout folder or archive instead of a synthetic one")
+    parser.add_argument("--jobs", default="1", help="comma-separated --jobs values to benchmark, e.g. 1,4")
+    parser.add_argument("--repeat", type=int, default=3, help="runs for each --jobs value, the fastest is kept")
+    parser.add_argument("--converter-args", default="",
+                        help="extra options for every conversion, e.g. \"--parser html.parser\"")
+    parser.add_argument("--results", default=DEFAULT_RESULTS_FILENAME,
+                        help="JSON lines file the results are appended to and compared against")
+    parser.add_argument("--label", default="", help="note saved with the results, e.g. the change being measured")
+    args, generator_args = parser.parse_known_args()
+
+    with TemporaryDirectory() as work_dir:
+        if args.input:
+            input_path = args.input
+            tree = {"input": os.path.abspath(args.input)}
+        else:
+            input_path = os.path.join(work_dir, "takeout")
+            print("Generating synthetic Takeout folder: " + " ".join(generator_args))
+            subprocess.run([sys.executable, str(GENERATOR), input_path, *generator_args], check=True)
+            tree = {"generator_args": generator_args}
+        tree["input_bytes"] = get_input_size(input_path)
+
+        previous_results = load_results(args.results)
+        for jobs in [int(jobs) for jobs in args.jobs.split(",")]:
+            runs = [run_conversion(input_path, tree["input_bytes"], work_dir, jobs, args.converter_args.split())
+                    for _ in range(args.repeat)]
+            result = {
+                "time": datetime.now().isoformat(timespec="seconds"),
+                "label": args.label,
+                "version": get_version(),
+                "python": platform.python_version(),
+                "tree": tree,
+                "jobs": jobs,
+                "converter_args": args.converter_args,
+                **min(runs, key=lambda run: run["wall_seconds"]),
+                "all_wall_seconds": [run["wall_seconds"] for run in runs],
+            }
+            print_result(result, find_previous_result(previous_results, result))
+            with open(args.results, "a", encoding="utf8") as results_file:
+                results_file.write(json.dumps(result) + "\n")
+
+# Function to run one conversion in a fresh output folder, returning its timings, throughput and peak memory of its
+# largest process
+def run_conversion(input_path, input_bytes, work_dir, jobs, converter_args):
+    output_dir = os.path.join(work_dir, "output")
+    os.makedirs(output_dir, exist_ok=True)
+    stats_filename = os.path.join(output_dir, "stats.json")
+    command = [
+        sys.executable, str(CONVERTER), "--input", input_path, "--process", "both", "--cleanup", "keep",
+        "--jobs", str(jobs), "--sms-output", os.path.join(output_dir, "sms.xml"),
+        "--calls-output", os.path.join(output_dir, "calls.xml"), "--stats-json", stats_filename, *converter_args,
+    ]
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    # wait4 also reports a memory high-water mark. It is that of the single largest process among the conversion and
+    # the workers it waited for, not their sum, so with --jobs the total is higher.
+    if hasattr(os, "wait4"):
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        largest_rss_mb = usage.ru_maxrss / 1024 if sys.platform != "darwin" else usage.ru_maxrss / 1024 / 1024
+    else:
+        process.wait()
+        largest_rss_mb = None
+    wall_seconds = time.perf_counter() - start
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+    with open(stats_filename, "r", encoding="utf8") as stats_file:
+        stats = json.load(stats_file)
+    output_bytes = stats["sms_bytes"] + stats["call_bytes"]
+    for output_filename in os.listdir(output_dir):
+        os.remove(os.path.join(output_dir, output_filename))
+    return {
+        "wall_seconds": wall_seconds,
+        "stages": stats["stages"],
+        "files": stats["files"],
+        "messages": stats["messages"],
+        "calls": stats["calls"],
+        "messages_per_second": stats["messages"] / wall_seconds,
+        "input_mb_per_second": input_bytes / 1024 / 1024 / wall_seconds,
+        "output_mb_per_second": output_bytes / 1024 / 1024 / wall_seconds,
+        "output_bytes": output_bytes,
+        "largest_process_rss_mb": largest_rss_mb,
+    }
+
+def get_input_size(input_path):
+    if os.path.isfile(input_path):
+        return os.path.getsize(input_path)
+    return sum(os.path.getsize(os.path.join(root, filename))
+               for root, _, filenames in os.walk(input_path) for filename in filenames)
+
+# Function to describe the code being benchmarked, the git commit when there is one
+def get_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=SCRIPT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_results(results_filename):
+    if not os.path.exists(results_filename):
+        return []
+    with open(results_filename, "r", encoding="utf8") as results_file:
+        return [json.loads(line) for line in results_file if line.strip()]
+
+# Function to find the latest earlier result for the same input, --jobs value and converter options
+def find_previous_result(previous_results, result):
+    for previous in reversed(previous_results):
+        if all(previous.get(key) == result[key] for key in ("tree", "jobs", "converter_args")):
+            return previous
+    return None
+
+def print_result(result, previous):
+    print(f"\n--jobs {result['jobs']}: {result['wall_seconds']:.2f}s, {result['messages_per_second']:.0f} messages/s, "
+          f"{result['input_mb_per_second']:.1f} MB/s read, {result['output_mb_per_second']:.1f} MB/s written, "
+          + (f"largest process RSS {result['largest_process_rss_mb']:.0f} MB"
+             if result["largest_process_rss_mb"] is not None else "largest process RSS unknown"))
+    for stage, seconds in result["stages"].items():
+        line = f"  {stage:<12}{seconds:8.2f}s"
+        if previous and stage in previous["stages"]:
+            line += f"  (was {previous['stages'][stage]:.2f}s)"
+        print(line)
+    if previous:
+        change = (result["wall_seconds"] / previous["wall_seconds"] - 1) * 100
+        print(f"  {change:+.1f}% wall time compared to {previous['version']} at {previous['time']}")
+
+if __name__ == "__main__":
+    main()
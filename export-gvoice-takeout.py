@@ -1,32 +1,58 @@
+import argparse
+import cProfile
 import glob
+import gzip
+import hashlib
+import heapq
+import html
+import json
 import os
 import re
+import sqlite3
+import struct
+import tarfile
+import threading
 import time
+import traceback
+import zlib
 import isodate
 import dateutil.parser
 import phonenumbers
+from array import array
 from base64 import b64encode
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
 from datetime import datetime, timedelta
-from io import open  # adds emoji support
-from pathlib import Path
-from shutil import copyfileobj, move
-from tempfile import NamedTemporaryFile
-from time import strftime
-from bs4 import BeautifulSoup
-
-# Call Files
-call_log_filename = "./gvoice-takeout-calls.xml"
-call_log_path = Path(call_log_filename)
-# Clear file if it already exists
-call_log_path.open("w").close()
-print("New call log file will be saved to " + call_log_filename)
-
-# SMS Files
-sms_log_filename = "./gvoice-takeout-sms.xml"
-sms_log_path = Path(sms_log_filename)
-# Clear file if it already exists
-sms_log_path.open("w").close()
-print("New SMS file will be saved to " + sms_log_filename)
+from functools import lru_cache, partial
+from io import open, DEFAULT_BUFFER_SIZE, StringIO, TextIOWrapper  # adds emoji support
+from multiprocessing import Pool
+from queue import Queue
+from pathlib import Path, PurePosixPath
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from time import perf_counter, strftime
+from zipfile import ZipFile, ZipInfo, is_zipfile
+from bs4 import BeautifulSoup, SoupStrainer
+
+# lxml is optional, without it conversations are parsed with BeautifulSoup's html.parser
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+# zstandard is optional, without it the output can only be compressed with gzip
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Default output files
+DEFAULT_CALL_LOG_FILENAME = "./gvoice-takeout-calls.xml"
+DEFAULT_SMS_LOG_FILENAME = "./gvoice-takeout-sms.xml"
+
+# Command line choices for what to process, mapped to the answers of the interactive prompt
+PROCESS_CHOICES = {"sms": '1', "calls": '2', "both": '3'}
 
 CALL_TAG_TO_TYPE = {
     'Received': 1,
@@ -44,12 +70,199 @@ IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic'}
 VCARD_EXTENSION = {'.vcf'}
 ALLOWED_EXTENSIONS = IMAGE_EXTENSIONS | VCARD_EXTENSION | VIDEO_EXTENSIONS
 
-def main():
+# Tags that BeautifulSoup serializes as "<tag/>", needed to reproduce its message text from lxml
+VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem', 'meta',
+                 'param', 'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex',
+                 'nextid', 'spacer'}
+
+# Attributes that BeautifulSoup splits into a list of values and prints joined by single spaces, by tag ("*" is any tag)
+SOUP_LIST_ATTRIBUTES = {'*': {'class', 'accesskey', 'dropzone'}, 'a': {'rel', 'rev'}, 'link': {'rel', 'rev'},
+                        'td': {'headers'}, 'th': {'headers'}, 'form': {'accept-charset'}, 'object': {'archive'},
+                        'area': {'rel'}, 'icon': {'sizes'}, 'iframe': {'sandbox'}, 'output': {'for'}}
+
+# Message text, and a start tag in it that repeats an attribute name. A repeat inside a quoted value matches too.
+MESSAGE_TEXT_PATTERN = re.compile(rb"<q\b[^>]*>(.*?)</q>", re.DOTALL)
+REPEATED_ATTRIBUTE_PATTERN = re.compile(rb"""<[a-zA-Z][^>]*?\s([^\s"'/>=]+)\s*=[^>]*\s\1\s*=""", re.IGNORECASE)
+
+# Output files
+DEFAULT_OUTPUT_BUFFER_SIZE = 4 * 1024 * 1024
+FSYNC_POLICIES = ("none", "close", "conversation")
+HEADER_COUNT_WIDTH = 21  # Room for any 64-bit count and its closing quote
+SPILL_MEMORY_LIMIT = 1024 * 1024  # Largest conversation a --jobs worker hands back in memory instead of a spill file
+
+# Compressed output, the suffix is added to the output file names
+COMPRESSION_SUFFIXES = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+COMPRESSION_QUEUE_SIZE = 4  # Buffers waiting for the compression thread
+
+# Seconds between progress lines while parsing and converting
+PROGRESS_INTERVAL = 5
+
+# Merging earlier output files
+DEDUP_INDEX_INITIAL_SLOTS = 1 << 16
+RECORD_ATTRIBUTE_PATTERN = re.compile(rb' ([a-z_]+)="([^"]*)"')
+
+# Sorting the output by date. Records are framed in the run files with their date, their position in the unsorted
+# file and their length.
+SORT_RECORD_HEADER = struct.Struct("<qQQ")
+SORT_MAX_FAN_IN = 16  # Runs merged at once, more are merged in several passes
+
+# SQLite store of parsed records. Rows are inserted this many at a time, and the indexes are built after the inserts.
+STORE_BATCH_SIZE = 10000
+STORE_SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+-- kind is sms or mms, type is the SMS type or the MMS msg_box (1 received, 2 sent)
+CREATE TABLE messages (id INTEGER PRIMARY KEY, kind TEXT, address TEXT, date INTEGER, type INTEGER,
+                       m_type INTEGER, text_only INTEGER, body TEXT, tr_id TEXT);
+CREATE TABLE addrs (message_id INTEGER, seq INTEGER, number TEXT, code INTEGER,
+                    PRIMARY KEY (message_id, seq)) WITHOUT ROWID;
+-- name is relative to the root_path in meta, which with the archive in meta, if any, locates the file
+CREATE TABLE attachments (message_id INTEGER, seq INTEGER, content_type TEXT, name TEXT, size INTEGER,
+                          PRIMARY KEY (message_id, seq)) WITHOUT ROWID;
+CREATE TABLE calls (id INTEGER PRIMARY KEY, number TEXT, date INTEGER, duration INTEGER, type INTEGER);
+"""
+STORE_INDEXES = """
+CREATE INDEX messages_address ON messages (address);
+CREATE INDEX messages_date ON messages (date);
+CREATE INDEX addrs_number ON addrs (number);
+CREATE INDEX calls_number ON calls (number);
+CREATE INDEX calls_date ON calls (date);
+"""
+STORE_RECORD_TYPES = ("sms", "mms", "calls")
+
+# Conversations converted between writes of the checkpoint manifest
+CHECKPOINT_INTERVAL = 64
+# Version of the XML written for a conversation, saved in the checkpoint manifest. Bump it with any change that alters
+# the output for the same input, so a checkpoint made by an older version of the script isn't reused.
+OUTPUT_FORMAT_VERSION = 2
+# Suffix of the output files of earlier runs that a checkpointed run copies from
+PREVIOUS_SUFFIX_PATTERN = re.compile(r"\.prev\d*$")
+
+# Parsing
+NUMBER_CACHE_SIZE = 4096
+TEXT_THREAD_FILENAME_PATTERN = re.compile(r" - Text - \d{4}-\d\d-\d\dT")
+ISO_TIMESTAMP_PATTERN = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d+))?(Z|[+-]\d\d:\d\d)?')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert Google Voice Takeout to SMS Backup & Restore XML")
+    parser.add_argument("--input", default=".",
+                        help="folder containing the extracted Takeout folder, or the Takeout .zip/.tgz archive itself "
+                             "(default: the current folder)")
+    parser.add_argument("--sms-output", default=DEFAULT_SMS_LOG_FILENAME, help="path of the SMS/MMS XML file")
+    parser.add_argument("--calls-output", default=DEFAULT_CALL_LOG_FILENAME, help="path of the call log XML file")
+    parser.add_argument("--process", choices=PROCESS_CHOICES,
+                        help="what to convert; asked interactively when omitted")
+    parser.add_argument("--cleanup", choices=("remove", "keep"),
+                        help="whether to delete conversations that won't convert before converting; "
+                             "asked interactively when omitted")
+    parser.add_argument("--jobs", type=non_negative_int, default=1,
+                        help="number of processes used to parse and convert conversations (0 = one per CPU)")
+    parser.add_argument("--attachment-cache-mb", type=non_negative_int, default=256,
+                        help="memory for caching base64-encoded attachments that repeat, shared across all jobs")
+    parser.add_argument("--attachment-cache-dir",
+                        help="directory to spill cached attachments to instead of dropping them when memory is full")
+    parser.add_argument("--prefetch-threads", type=non_negative_int, default=4,
+                        help="threads reading upcoming attachments while earlier conversations are written (0 = off)")
+    parser.add_argument("--prefetch-mb", type=non_negative_int, default=64,
+                        help="most memory held by attachments read ahead, shared across all jobs")
+    parser.add_argument("--output-buffer-mb", type=non_negative_int, default=4,
+                        help="write buffer size for each output file")
+    parser.add_argument("--fsync", choices=FSYNC_POLICIES, default="none",
+                        help="when to fsync the output files: never, once when they are closed, or after every conversation")
+    parser.add_argument("--parser", choices=CONVERSATION_PARSERS, default="lxml" if etree else "html.parser",
+                        help="HTML parser backend; lxml is much faster, html.parser is the BeautifulSoup reference")
+    parser.add_argument("--split-mb", type=non_negative_int, default=0,
+                        help="start a new numbered SMS part file once a part reaches this size (0 = one file)")
+    parser.add_argument("--split-messages", type=non_negative_int, default=0,
+                        help="start a new numbered SMS part file once a part would exceed this many messages "
+                             "(0 = one file)")
+    parser.add_argument("--checkpoint",
+                        help="manifest file recording converted conversations; a run with the same manifest reuses "
+                             "the output of conversations that haven't changed and only converts the rest")
+    parser.add_argument("--sort-by-date", action="store_true",
+                        help="write messages and calls in date order instead of file by file; can't be combined "
+                             "with --checkpoint or splitting")
+    parser.add_argument("--sort-buffer-mb", type=non_negative_int, default=64,
+                        help="memory for sorting with --sort-by-date, larger outputs are sorted in runs on disk")
+    parser.add_argument("--compress", choices=COMPRESSION_SUFFIXES, default="none",
+                        help="compress the output files while they are written, adding .gz or .zst to their names")
+    parser.add_argument("--stats-json",
+                        help="file to save the run's counts, output sizes, time spent in each stage and the "
+                             "timers of the instrumented steps to, as JSON")
+    parser.add_argument("--profile",
+                        help="profile the run with cProfile and save the stats to this file, for pstats or snakeviz; "
+                             "with --jobs above 1 only the main process is profiled")
+    parser.add_argument("--merge", nargs="+", metavar="PATH",
+                        help="instead of converting --input, merge these earlier output files (SMS or calls XML, also "
+                             ".gz/.zst) and Takeout folders or archives, which are converted first, into one SMS file "
+                             "and one calls file without duplicate messages or calls")
+    parser.add_argument("--save-store", metavar="PATH",
+                        help="instead of writing XML, parse --input into an SQLite database that --from-store can "
+                             "write the XML from again and again without re-parsing")
+    parser.add_argument("--from-store", metavar="PATH",
+                        help="write the XML from a database made by --save-store instead of converting --input, "
+                             "optionally filtered with --contact, --since, --before and --record-types")
+    parser.add_argument("--contact", help="with --from-store, only messages and calls with this number")
+    parser.add_argument("--since", help="with --from-store, only messages and calls at or after this local date or "
+                                        "time, e.g. 2021-06-01 or 2021-06-01T18:00")
+    parser.add_argument("--before", help="with --from-store, only messages and calls before this local date or time")
+    parser.add_argument("--record-types", nargs="+", choices=STORE_RECORD_TYPES, default=STORE_RECORD_TYPES,
+                        help="with --from-store, which kinds of records to write (default: all)")
+    args = parser.parse_args(argv)
+    if args.parser == "lxml" and etree is None:
+        parser.error("--parser lxml needs the lxml package")
+    if args.compress == "zstd" and zstandard is None:
+        parser.error("--compress zstd needs the zstandard package")
+    if args.merge:
+        merge_outputs(args)
+        return
+    if args.save_store:
+        save_store(args)
+        return
+    if args.from_store:
+        render_store(args)
+        return
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    if args.sort_by_date and (args.checkpoint or args.split_mb or args.split_messages):
+        parser.error("--sort-by-date can't be combined with --checkpoint, --split-mb or --split-messages")
+    jobs = args.jobs or os.cpu_count()
+    output_buffer_size = args.output_buffer_mb * 1024 * 1024
+    root_dir = args.input
+    call_log_filename = args.calls_output + COMPRESSION_SUFFIXES[args.compress]
+    sms_log_filename = args.sms_output
+
+    # Read the manifest of the run whose output can be reused. Nothing is moved or cleared before the prompts.
+    checkpoint = load_checkpoint(args.checkpoint, call_log_filename) if args.checkpoint else None
+
     start_time=datetime.now()
     print("Start time: ", start_time.strftime("%H:%M:%S"))
-    print("Current working directory:", os.getcwd())
-    # Get user choices from user_setup()
-    user_confirmation_process, should_delete = user_setup()
+    print("Input folder:", os.path.abspath(root_dir))
+    # Get user choices from the command line, or from user_setup() prompts for those that weren't given
+    user_confirmation_process, should_delete = user_setup(args.process, args.cleanup, root_dir)
+    # Converting only calls needs nothing but the call of each call file, so text threads aren't parsed at all
+    if user_confirmation_process == '2':
+        parse_html_file = CALL_PARSERS[args.parser]
+    else:
+        parse_html_file = CONVERSATION_PARSERS[args.parser]
+    # Commit this run's manifest and set aside the output files it reuses before they are cleared
+    if checkpoint:
+        start_checkpoint(checkpoint, user_confirmation_process)
+
+    # Open the output files once for the whole run, clearing them if they already exist. This happens here,
+    # not at import, so worker processes never touch them.
+    call_sink = OutputSink(call_log_filename, output_buffer_size, args.fsync, args.compress)
+    print("New call log file will be saved to " + call_log_filename)
+    sms_output = new_sms_output(sms_log_filename, args.split_mb * 1024 * 1024, args.split_messages,
+                                output_buffer_size, args.fsync, args.compress)
+    print("New SMS file will be saved to " + sms_output["sink"].path)
+    # Reserve the headers now, their counts are patched in place once the run finishes
+    if user_confirmation_process in ('1', '3'):
+        start_sms_header(sms_output)
+    if user_confirmation_process in ('2', '3'):
+        calls_header_offset = write_calls_header(call_sink)
     # Begin execution
     print("Checking directory for *.html files")
     num_sms = 0
@@ -57,70 +270,142 @@ def main():
     num_vcf = 0
     num_vid = 0
     num_calls = 0
-    root_dir = "."
     own_number = None
 
-    # Create the src to filename mapping
-    src_elements = extract_src(".")  # Assuming current directory
-    att_filenames = list_att_filenames(".")    # Assuming current directory
+    # Time spent in each stage of the run, in seconds
+    stage_times = OrderedDict()
+    stage_start = time.perf_counter()
+
+    # Walk the Takeout folder or archive once, then parse every conversation exactly once
+    takeout_index = index_takeout(root_dir, should_delete)
+    use_takeout_archive(takeout_index["archive"])
+    att_filenames = [os.path.basename(att_path) for att_path in takeout_index["attachments"]]
     num_img = sum(1 for filename in att_filenames if Path(filename).suffix.lower() in IMAGE_EXTENSIONS)
     num_vcf = sum(1 for filename in att_filenames if Path(filename).suffix.lower() in VCARD_EXTENSION)
     num_vid = sum(1 for filename in att_filenames if Path(filename).suffix.lower() in VIDEO_EXTENSIONS)
-    src_filename_map = src_to_filename_mapping(src_elements, att_filenames)
-
-    for subdir, dirs, files in os.walk(root_dir):
-        for file in files:
-            sms_filename = os.path.join(subdir, file)
-
-            if os.path.splitext(sms_filename)[1] != ".html":
-                #print(sms_filename,"- skipped")
-                continue
-
-            print("Processing " + sms_filename)
 
-            is_group_conversation = re.match(r"(^Group Conversation)", file)
+    stage_start = end_stage(stage_times, "indexing", stage_start)
 
-            with open(sms_filename, "r", encoding="utf8") as sms_file:
-                soup = BeautifulSoup(sms_file, "html.parser")
+    html_files = takeout_index["html_files"]
+    print(f"Parsing {len(html_files)} *.html files")
+    chunksize = max(1, min(64, len(html_files) // (jobs * 16)))
+    parse_progress = new_progress("Parsed", len(html_files))
+    if jobs > 1:
+        with Pool(jobs, initializer=use_takeout_archive, initargs=(takeout_index["archive"],)) as pool:
+            conversations = collect_parsed_conversations(
+                pool.imap(partial(parse_timed, parse_html_file), html_files, chunksize), parse_progress)
+    else:
+        conversations = collect_parsed_conversations(map(partial(parse_timed, parse_html_file), html_files),
+                                                     parse_progress)
+    stage_start = end_stage(stage_times, "parsing", stage_start)
+
+    src_filename_map, att_path_index = index_conversation_attachments(conversations, takeout_index,
+                                                                      user_confirmation_process)
+    # Numbers for conversations titled with a contact name instead of a number come from this index, which is
+    # complete before any conversation is converted
+    fallback_numbers = index_fallback_numbers(conversations)
+
+    # Each process gets an equal share of the attachment cache memory
+    cache_spill_dir = TemporaryDirectory(dir=args.attachment_cache_dir) if args.attachment_cache_dir else None
+    attachment_cache_config = (
+        args.attachment_cache_mb * 1024 * 1024 // jobs,
+        cache_spill_dir.name if cache_spill_dir else None,
+        get_shared_sizes(takeout_index["attachments"].values()),
+        get_repeated_paths(conversations, src_filename_map, att_path_index),
+        get_prefetch_threads(args.prefetch_threads, takeout_index["archive"] and takeout_index["archive"][0]),
+        args.prefetch_mb * 1024 * 1024 // jobs,
+    )
 
-            messages_raw = soup.find_all(class_="message")
-            # Extracting own phone number if the <abbr> tag with class "fn" contains "Me"
-            for abbr_tag in soup.find_all('abbr', class_='fn'):
-                if abbr_tag.get_text(strip=True) == "Me":
-                    a_tag = abbr_tag.find_previous('a', class_='tel')
-                if a_tag:
-                    own_number = a_tag.get('href').split(':', 1)[-1]  # Extracting number from href
-                    break
-            
-            # Gate SMS processing
-            if user_confirmation_process in ('1', '3'):
-                num_sms += len(messages_raw)
-
-                if len(messages_raw):
-                    if is_group_conversation:
-                        participants_raw = soup.find_all(class_="participants")
-                        write_mms_messages(file, participants_raw, messages_raw, own_number, src_filename_map)
-                    else:
-                        write_sms_messages(file, messages_raw, own_number, src_filename_map)
-            
-            # Gate Call processing
-            if user_confirmation_process in ('2', '3'):
-                call_raw = soup.find(class_="haudio")
-                if call_raw:
-                    num_calls += write_call(call_raw, call_log_filename)
+    # The owner's number carries over from file to file, so resolve it in file order before converting
+    render_tasks = []
+    render_keys = []
+    reused_entries = []
+    me_tel = None
+    for conversation in conversations:
+        me_tel, own_number = update_own_number(conversation, me_tel, own_number)
+        render_tasks.append((conversation, own_number))
+
+        # Conversations whose output would be the same as in the checkpointed run are copied from it
+        if checkpoint:
+            render_key = get_render_key(conversation, own_number, src_filename_map, fallback_numbers)
+            render_keys.append(render_key)
+            reused_entries.append(find_checkpoint_entry(checkpoint, conversation["path"], render_key))
+        else:
+            render_keys.append(None)
+            reused_entries.append(None)
+
+        # Gate SMS processing
+        if user_confirmation_process in ('1', '3'):
+            num_sms += len(conversation["messages"])
+    stage_start = end_stage(stage_times, "mapping", stage_start)
+
+    render_progress = new_progress("Converted", len(render_tasks))
+    try:
+        if jobs > 1:
+            # Workers render each conversation in memory, or into a spill file of its own if it is large; imap hands
+            # them back in
+            # file order, and the SMS part is copied over in chunks so attachments are never held in memory
+            with TemporaryDirectory(dir=os.path.dirname(os.path.abspath(sms_log_filename))) as spill_dir, \
+                    Pool(jobs, initializer=init_render_worker,
+                         initargs=(user_confirmation_process, src_filename_map, att_path_index, fallback_numbers,
+                                   takeout_index["archive"], spill_dir, attachment_cache_config)) as pool:
+                worker_results = {"cache_stats": {}, "metrics": {}}
+                fragments = pool.imap(render_conversation_fragments,
+                                      [task for task, entry in zip(render_tasks, reused_entries) if not entry],
+                                      chunksize)
+                num_calls += write_conversations(
+                    render_tasks, render_keys, reused_entries, partial(copy_next_fragment, fragments, worker_results),
+                    sms_output, call_sink, checkpoint, render_progress)
+            cache_stats = [sum(worker_stats)
+                           for worker_stats in zip((0, 0, 0), *worker_results["cache_stats"].values())]
+            for metrics in worker_results["metrics"].values():
+                merge_metrics(metrics)
+        else:
+            attachment_cache = new_attachment_cache(*attachment_cache_config)
+            # Records are made a few conversations ahead, so their attachments are read while earlier ones are written
+            records_ahead = prefetch_ahead(
+                (list(iter_conversation_records(conversation, own_number, user_confirmation_process, src_filename_map,
+                                                att_path_index, fallback_numbers))
+                 for (conversation, own_number), entry in zip(render_tasks, reused_entries) if not entry),
+                attachment_cache)
+            num_calls += write_conversations(
+                render_tasks, render_keys, reused_entries,
+                partial(render_next_records, records_ahead, attachment_cache), sms_output, call_sink, checkpoint,
+                render_progress)
+            cache_stats = get_attachment_cache_stats(attachment_cache)
+            close_attachment_cache(attachment_cache)
+    finally:
+        # Record what was converted so far, so a failed run can be resumed
+        if checkpoint:
+            write_checkpoint(checkpoint, sms_output["sink"], call_sink)
+
+    if cache_spill_dir:
+        cache_spill_dir.cleanup()
+    close_takeout_archive()
+    stage_start = end_stage(stage_times, "rendering", stage_start)
 
     # Finalize files based on user selection
-    if user_confirmation_process in ('1', '3'):
-        sms_log_file = open(sms_log_filename, "a")
-        sms_log_file.write("</smses>")
-        sms_log_file.close()
-        write_sms_header(sms_log_filename, num_sms)
+    close_sms_output(sms_output)
+    if user_confirmation_process in ('2', '3'):
+        call_sink.write("</calls>")
+    call_sink.close()
+    print(f"Wrote {sms_output['bytes_written']} bytes of messages and {call_sink.bytes_written} bytes of calls")
+    if len(sms_output["parts"]) > 1:
+        print(f"Messages were split into {len(sms_output['parts'])} files: {', '.join(sms_output['parts'])}")
 
     if user_confirmation_process in ('2', '3'):
-        call_log_file = open(call_log_filename, "a")
-        call_log_file.write("</calls>")
-        call_log_file.close()
-        write_calls_header(call_log_filename, num_calls)
+        call_sink.patch(calls_header_offset, format_calls_header(num_calls))
+
+    if checkpoint:
+        print(f"Reused {checkpoint['reused']} conversations from the checkpoint")
+        close_checkpoint(checkpoint, [*sms_output["parts"], call_log_filename])
+    stage_start = end_stage(stage_times, "finalizing", stage_start)
+
+    if args.sort_by_date:
+        for output_filename in (*sms_output["parts"], call_log_filename):
+            sort_output_file(output_filename, args.sort_buffer_mb * 1024 * 1024, output_buffer_size, args.fsync,
+                             args.compress)
+        end_stage(stage_times, "sorting", stage_start)
 
     end_time=datetime.now()
     elapsed_time = end_time - start_time
@@ -137,6 +422,1199 @@ def main():
         parts.append(f"{seconds} seconds")
     time_str = ", ".join(parts)
     print(f"Processed {num_calls} calls, {num_sms} messages, {num_img} images, {num_vid} videos, and {num_vcf} contact cards in {time_str}")
+    cache_hits, cache_misses, cache_bytes_saved = cache_stats
+    print(f"Attachment cache: {cache_hits} hits, {cache_misses} misses, {cache_bytes_saved / 1024 / 1024:.1f} MB not re-encoded")
+    if run_metrics["calls"]["prefetch_read"]:
+        print(f"Attachment prefetch: {run_metrics['calls']['prefetch_read']} attachments read ahead, "
+              f"{run_metrics['seconds']['prefetch_read']:.2f}s reading in the background, "
+              f"{run_metrics['seconds']['prefetch_wait']:.2f}s waiting for them")
+    print("Stage times: " + ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in stage_times.items()))
+    print("Time in steps, summed over processes: " + ", ".join(
+        f"{step} {run_metrics['seconds'][step]:.2f}s ({run_metrics['calls'][step]} calls)"
+        for step in METRIC_STEPS if run_metrics["calls"][step]))
+    if args.stats_json:
+        with open(args.stats_json, "w", encoding="utf8") as stats_file:
+            json.dump({
+                "elapsed": elapsed_time.total_seconds(),
+                "stages": stage_times,
+                "jobs": jobs,
+                "parser": args.parser,
+                "files": len(html_files),
+                "messages": num_sms,
+                "calls": num_calls,
+                "images": num_img,
+                "videos": num_vid,
+                "contact_cards": num_vcf,
+                "sms_bytes": sms_output["bytes_written"],
+                "call_bytes": call_sink.bytes_written,
+                "attachment_cache": dict(zip(("hits", "misses", "bytes_saved"), cache_stats)),
+                "step_seconds": run_metrics["seconds"],
+                "step_calls": run_metrics["calls"],
+            }, stats_file, indent=2)
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        print(f"Profile saved to {args.profile}, view it with: python -m pstats {args.profile}")
+
+# Function to parse a count option that can't be negative, so argparse rejects it before anything runs
+def non_negative_int(value):
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must be 0 or more, got {number}")
+    return number
+
+# Cumulative seconds and number of calls of the instrumented steps in this process. Steps nest, render includes
+# attachment_encode, prefetch_wait and write. prefetch_read is time spent reading in prefetch threads, prefetch_wait
+# the part of it the conversion had to wait for.
+METRIC_STEPS = ("parse", "find_file_path", "attachment_encode", "render", "write", "prefetch_read", "prefetch_wait")
+run_metrics = {"seconds": Counter(), "calls": Counter()}
+
+def add_metric(step, start):
+    run_metrics["seconds"][step] += perf_counter() - start
+    run_metrics["calls"][step] += 1
+
+# Function to add the metrics of a worker process to this process's
+def merge_metrics(metrics):
+    run_metrics["seconds"].update(metrics["seconds"])
+    run_metrics["calls"].update(metrics["calls"])
+
+# Function run in parse worker processes: parses a file and returns the conversation with the seconds it took
+def parse_timed(parse_html_file, sms_filename):
+    start = perf_counter()
+    conversation = parse_html_file(sms_filename)
+    return conversation, perf_counter() - start
+
+def collect_parsed_conversations(parse_results, parse_progress):
+    conversations = []
+    for conversation, parse_seconds in parse_results:
+        run_metrics["seconds"]["parse"] += parse_seconds
+        run_metrics["calls"]["parse"] += 1
+        conversations.append(conversation)
+        update_progress(parse_progress, len(conversation["messages"]))
+    return conversations
+
+def new_progress(action, total):
+    return {
+        "action": action,
+        "total": total,
+        "done": 0,
+        "messages": 0,
+        "start": time.perf_counter(),
+        "printed": time.perf_counter(),
+    }
+
+# Function to count a finished file, printing a progress line every PROGRESS_INTERVAL seconds and at the end
+def update_progress(progress, num_messages, bytes_written=None):
+    progress["done"] += 1
+    progress["messages"] += num_messages
+    now = time.perf_counter()
+    if now - progress["printed"] < PROGRESS_INTERVAL and progress["done"] < progress["total"]:
+        return
+    progress["printed"] = now
+    elapsed = max(now - progress["start"], 1e-9)
+    remaining = (progress["total"] - progress["done"]) * elapsed / progress["done"]
+    line = (f"{progress['action']} {progress['done']}/{progress['total']} files, "
+            f"{progress['messages'] / elapsed:.0f} messages/s")
+    if bytes_written is not None:
+        line += f", {bytes_written / 1024 / 1024:.1f} MB written"
+    print(line + f", ETA {timedelta(seconds=round(remaining))}")
+
+# Function to record how long a stage of the run took, returning the start of the next stage
+def end_stage(stage_times, stage, stage_start):
+    stage_end = time.perf_counter()
+    stage_times[stage] = stage_end - stage_start
+    return stage_end
+
+# Output file opened once per run. Text is encoded to UTF-8 and written through a large buffer, without newline
+# translation, and the number of bytes written is kept so it can be logged. With compression, the buffered bytes are
+# compressed and written by a background thread, so compressing overlaps with converting; bytes_written still counts
+# uncompressed bytes.
+class OutputSink:
+    def __init__(self, path, buffer_size=DEFAULT_OUTPUT_BUFFER_SIZE, fsync_policy="none", compression="none"):
+        self.path = path
+        self.fsync_policy = fsync_policy
+        self.compression = compression
+        self.bytes_written = 0
+        if compression == "none":
+            self.file = open(path, "wb", buffering=buffer_size)
+            return
+        self.file = open(path, "wb")
+        self.buffer = bytearray()
+        self.buffer_size = buffer_size
+        self.compressor = None  # Started with the first data after a reserved region
+        self.error = None
+        self.queue = Queue(COMPRESSION_QUEUE_SIZE)
+        self.thread = threading.Thread(target=self.compress_buffers, daemon=True)
+        self.thread.start()
+
+    def write(self, data):
+        start = perf_counter()
+        if isinstance(data, str):
+            data = data.encode("utf8")
+        self.bytes_written += len(data)
+        if self.compression == "none":
+            self.file.write(data)
+        else:
+            self.buffer += data
+            if len(self.buffer) >= self.buffer_size:
+                self.send_buffer()
+        add_metric("write", start)
+
+    def writelines(self, chunks):
+        self.write("".join(chunks))
+
+    # Function to write data that will be replaced by patch() with data of the same length once the file is closed.
+    # Returns its offset in the file. A compressed file can't be patched inside a compressed stream, so there the
+    # data gets a gzip member or zstd frame of its own that stores it uncompressed.
+    def reserve(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf8")
+        if self.compression == "none":
+            offset = self.file.tell()
+            self.write(data)
+            return offset
+        self.wait_for_thread()
+        self.finish_compressor()
+        offset = self.file.tell()
+        self.file.write(get_stored_member(data, self.compression))
+        self.bytes_written += len(data)
+        return offset
+
+    def patch(self, offset, data):
+        if isinstance(data, str):
+            data = data.encode("utf8")
+        if self.compression != "none":
+            data = get_stored_member(data, self.compression)
+        with open(self.path, "r+b") as output_file:
+            output_file.seek(offset)
+            output_file.write(data)
+
+    # A flush also ends the current compressed block, so what was written so far can be decompressed from the file
+    def flush(self, fsync=False):
+        if self.compression != "none":
+            self.wait_for_thread(sync=True)
+        self.file.flush()
+        if fsync:
+            os.fsync(self.file.fileno())
+
+    # Called after each conversation, only flushes when every conversation should be synced to disk
+    def end_conversation(self):
+        if self.fsync_policy == "conversation":
+            self.flush(fsync=True)
+
+    def close(self):
+        if not self.file.closed:
+            if self.compression != "none":
+                self.wait_for_thread()
+                self.finish_compressor()
+                self.queue.put(None)
+                self.thread.join()
+            self.file.flush()
+            if self.fsync_policy != "none":
+                os.fsync(self.file.fileno())
+            self.file.close()
+
+    def send_buffer(self):
+        if self.error:
+            raise self.error
+        if self.buffer:
+            self.queue.put(bytes(self.buffer))
+            self.buffer.clear()
+
+    # Function to hand over the buffer and wait until the thread has written everything, after which the file and
+    # compressor can be used from this thread
+    def wait_for_thread(self, sync=False):
+        self.send_buffer()
+        written = threading.Event()
+        self.queue.put((written, sync))
+        written.wait()
+        if self.error:
+            raise self.error
+
+    def compress_buffers(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                if isinstance(item, tuple):
+                    written, sync = item
+                    if sync and self.compressor:
+                        self.file.write(flush_compressor(self.compressor, self.compression))
+                    written.set()
+                    continue
+                if self.compressor is None:
+                    self.compressor = new_compressor(self.compression)
+                self.file.write(self.compressor.compress(item))
+            except Exception as error:
+                self.error = error
+                if isinstance(item, tuple):
+                    item[0].set()
+
+    def finish_compressor(self):
+        if self.compressor:
+            self.file.write(self.compressor.flush())
+            self.compressor = None
+
+def new_compressor(compression):
+    if compression == "gzip":
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+# Function to end the current block without ending the gzip member or zstd frame
+def flush_compressor(compressor, compression):
+    if compression == "gzip":
+        return compressor.flush(zlib.Z_SYNC_FLUSH)
+    return compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+# Function to store data uncompressed in a gzip member or zstd frame of its own, its length depends only on the length
+# of the data. Decompressors read consecutive members or frames as one stream.
+def get_stored_member(data, compression):
+    assert len(data) < 65536
+    if compression == "gzip":
+        # Header without a name or mtime, one final stored deflate block, then the CRC and size
+        return (b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+                + struct.pack("<BHH", 1, len(data), len(data) ^ 0xffff) + data
+                + struct.pack("<II", zlib.crc32(data), len(data)))
+    # Single segment frame with a 4 byte content size and no checksum, holding one last raw block
+    return (struct.pack("<IBI", 0xFD2FB528, 0xa0, len(data))
+            + (1 | len(data) << 3).to_bytes(3, "little") + data)
+
+# Function to open an output file of an earlier run for reading, decompressing it if it was compressed
+def open_output_file(filename):
+    filename_without_prev = PREVIOUS_SUFFIX_PATTERN.sub("", filename)
+    if filename_without_prev.endswith(COMPRESSION_SUFFIXES["gzip"]):
+        return gzip.open(filename, "rb")
+    if filename_without_prev.endswith(COMPRESSION_SUFFIXES["zstd"]):
+        return ZstdOutputReader(filename)
+    return open(filename, "rb")
+
+# Function to find how many bytes an output file holds, decompressed. Reading stops where a compressed file that was
+# being written when its run stopped can no longer be decoded.
+def get_output_length(filename):
+    reader = open_output_file(filename)
+    if not isinstance(reader, (gzip.GzipFile, ZstdOutputReader)):
+        reader.close()
+        return os.path.getsize(filename)
+    # gzip's read1 returns what could be decoded so far, where read gives up on the whole chunk at a cut-off stream
+    read = reader.read1 if isinstance(reader, gzip.GzipFile) else reader.read
+    length = 0
+    try:
+        while chunk := read(ATTACHMENT_CHUNK_SIZE):
+            length += len(chunk)
+    except (EOFError, OSError):
+        pass
+    finally:
+        reader.close()
+    return length
+
+# Forward-only reader of a zstd output file. The file may end in an unfinished frame when the run that wrote it
+# stopped, which zstandard's stream_reader can give up on before reaching the end of the data.
+class ZstdOutputReader:
+    def __init__(self, filename):
+        self.file = open(filename, "rb")
+        self.decompressor = zstandard.ZstdDecompressor().decompressobj(read_across_frames=True)
+        self.buffer = b""
+        self.position = 0
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            data = self.file.read(ATTACHMENT_CHUNK_SIZE)
+            if not data:
+                break
+            self.buffer += self.decompressor.decompress(data)
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.position += len(chunk)
+        return chunk
+
+    def seek(self, offset):
+        assert offset >= self.position, "zstd output can only be read forward"
+        while self.position < offset and self.read(min(offset - self.position, ATTACHMENT_CHUNK_SIZE)):
+            pass
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.file.close()
+
+# Function to read a Takeout folder or archive as a stream of Sms, Mms and Call records, for scripts that want the
+# messages without the XML. The script's file name has dashes, so it is imported with importlib:
+#     converter = importlib.import_module("export-gvoice-takeout")
+#     for record in converter.iter_records("path/to/takeout"):
+# Conversations are all parsed first, since numbers and attachment names are resolved across files, then turned into
+# records one conversation at a time. Attachments are only read when opened, which has to be done while iterating.
+def iter_records(root_dir=".", process="both", parser="lxml" if etree else "html.parser", jobs=1):
+    user_confirmation_process = PROCESS_CHOICES[process]
+    if user_confirmation_process == '2':
+        parse_html_file = CALL_PARSERS[parser]
+    else:
+        parse_html_file = CONVERSATION_PARSERS[parser]
+    takeout_index = index_takeout(root_dir)
+    use_takeout_archive(takeout_index["archive"])
+    try:
+        html_files = takeout_index["html_files"]
+        if jobs > 1:
+            with Pool(jobs, initializer=use_takeout_archive, initargs=(takeout_index["archive"],)) as pool:
+                conversations = pool.map(parse_html_file, html_files, max(1, min(64, len(html_files) // (jobs * 16))))
+        else:
+            conversations = [parse_html_file(html_file) for html_file in html_files]
+        src_filename_map, att_path_index = index_conversation_attachments(conversations, takeout_index,
+                                                                          user_confirmation_process)
+        fallback_numbers = index_fallback_numbers(conversations)
+        me_tel = own_number = None
+        for conversation in conversations:
+            me_tel, own_number = update_own_number(conversation, me_tel, own_number)
+            yield from iter_conversation_records(conversation, own_number, user_confirmation_process,
+                                                 src_filename_map, att_path_index, fallback_numbers)
+    finally:
+        close_takeout_archive()
+
+# Function to create the src to filename mapping and the attachment path index from the parsed conversations.
+# Calls have no attachments.
+def index_conversation_attachments(conversations, takeout_index, user_confirmation_process):
+    if user_confirmation_process == '2':
+        return {}, None
+    att_filenames = [os.path.basename(att_path) for att_path in takeout_index["attachments"]]
+    src_elements = [src for conversation in conversations for src in conversation["srcs"]]
+    src_filename_map = src_to_filename_mapping(src_elements, att_filenames)
+    att_path_index = index_attachment_paths(takeout_index["attachments"], takeout_index["base_path"],
+                                            takeout_index["root_path"])
+    return src_filename_map, att_path_index
+
+# Function to pick up the owner's number from a conversation. It carries over from file to file, so conversations
+# have to be passed in file order, along with the previous call's results.
+def update_own_number(conversation, me_tel, own_number):
+    # Extracting own phone number if the <abbr> tag with class "fn" contains "Me"
+    for is_me, tel_href in conversation["fn_abbrs"]:
+        if is_me:
+            me_tel = tel_href
+        if me_tel:
+            own_number = me_tel.split(':', 1)[-1]  # Extracting number from href
+            break
+    return me_tel, own_number
+
+# Function to turn one parsed conversation into its records: its messages, then its call
+def iter_conversation_records(conversation, own_number, user_confirmation_process, src_filename_map, att_path_index,
+                              fallback_numbers):
+    file = conversation["file"]
+    is_group_conversation = re.match(r"(^Group Conversation)", file)
+    messages = conversation["messages"]
+
+    # Gate SMS processing
+    if user_confirmation_process in ('1', '3') and len(messages):
+        if is_group_conversation:
+            yield from iter_mms_records(file, conversation["participants"], messages, own_number, src_filename_map,
+                                        att_path_index)
+        else:
+            yield from iter_sms_records(file, messages, own_number, src_filename_map, att_path_index,
+                                        fallback_numbers)
+
+    # Gate Call processing
+    if user_confirmation_process in ('2', '3'):
+        call = conversation["call"]
+        if call:
+            call = new_call(call)
+        if call:
+            yield call
+
+# Function to convert one parsed conversation, writing its records to the given output files
+def render_conversation(conversation, own_number, user_confirmation_process, src_filename_map, att_path_index,
+                        fallback_numbers, attachment_cache, sms_backup_file, call_log_file):
+    records = list(iter_conversation_records(conversation, own_number, user_confirmation_process, src_filename_map,
+                                             att_path_index, fallback_numbers))
+    prefetch_attachments(attachment_cache, records)
+    return render_records(records, attachment_cache, sms_backup_file, call_log_file)
+
+def render_records(records, attachment_cache, sms_backup_file, call_log_file):
+    start = perf_counter()
+    num_calls = 0
+    for record in records:
+        if isinstance(record, Sms):
+            write_sms(record, sms_backup_file)
+        elif isinstance(record, Mms):
+            write_mms(record, attachment_cache, sms_backup_file)
+        else:
+            write_call(record, call_log_file)
+            num_calls += 1
+    add_metric("render", start)
+    return num_calls
+
+# Shared state for render worker processes, set once per worker instead of being sent with every conversation
+render_worker_context = {}
+
+def init_render_worker(user_confirmation_process, src_filename_map, att_path_index, fallback_numbers, archive,
+                       spill_dir, attachment_cache_config):
+    use_takeout_archive(archive)
+    render_worker_context["user_confirmation_process"] = user_confirmation_process
+    # Forked workers start with a copy of the main process's metrics, only their own are sent back
+    run_metrics["seconds"].clear()
+    run_metrics["calls"].clear()
+    render_worker_context["src_filename_map"] = src_filename_map
+    render_worker_context["att_path_index"] = att_path_index
+    render_worker_context["fallback_numbers"] = fallback_numbers
+    render_worker_context["attachment_cache"] = new_attachment_cache(*attachment_cache_config)
+    render_worker_context["spill_dir"] = spill_dir
+    render_worker_context["num_spill_files"] = 0
+
+# Function run in worker processes: converts one conversation and returns its SMS output, or the name of the spill
+# file it went to if it was large, along with the (small) rendered call fragment and the worker's cache stats and
+# metrics. The main process deletes each spill file once it is copied, so spill files never add up to a second copy
+# of the output.
+def render_conversation_fragments(render_task):
+    conversation, own_number = render_task
+    attachment_cache = render_worker_context["attachment_cache"]
+    spill_file = SpillSink(os.path.join(render_worker_context["spill_dir"],
+                                        f"spill-{os.getpid()}-{render_worker_context['num_spill_files']}.xml"))
+    render_worker_context["num_spill_files"] += 1
+    call_log_file = StringIO()
+    try:
+        num_calls = render_conversation(conversation, own_number, render_worker_context["user_confirmation_process"],
+                                        render_worker_context["src_filename_map"],
+                                        render_worker_context["att_path_index"],
+                                        render_worker_context["fallback_numbers"], attachment_cache, spill_file,
+                                        call_log_file)
+    except Exception as error:
+        # Handed back instead of raised, since imap would raise it at the first conversation of this task's chunk
+        # rather than at this one
+        return error, traceback.format_exc()
+    finally:
+        spill_file.close()
+    return (os.getpid(), spill_file.get_output(), call_log_file.getvalue(), num_calls,
+            get_attachment_cache_stats(attachment_cache), run_metrics)
+
+# Output of one conversation rendered in a worker process. It is kept in memory, unless it grows past
+# SPILL_MEMORY_LIMIT, usually with attachments, when it moves to a spill file of its own.
+class SpillSink:
+    def __init__(self, spill_path):
+        self.spill_path = spill_path
+        self.buffer = bytearray()
+        self.file = None
+        self.bytes_written = 0
+
+    def write(self, data):
+        start = perf_counter()
+        if isinstance(data, str):
+            data = data.encode("utf8")
+        self.bytes_written += len(data)
+        if self.file:
+            self.file.write(data)
+        else:
+            self.buffer += data
+            if len(self.buffer) > SPILL_MEMORY_LIMIT:
+                self.file = open(self.spill_path, "wb", buffering=DEFAULT_OUTPUT_BUFFER_SIZE)
+                self.file.write(self.buffer)
+                self.buffer = None
+        add_metric("write", start)
+
+    def writelines(self, chunks):
+        self.write("".join(chunks))
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+    # The output in memory as bytes, or the name of its spill file
+    def get_output(self):
+        return self.spill_path if self.file else bytes(self.buffer)
+
+# Exception holding the traceback of an error in a worker process, chained to the error when it is raised again in
+# the main process
+class WorkerTraceback(Exception):
+    pass
+
+# Function to write every conversation to the output in file order. Conversations found in the checkpoint are copied
+# from the earlier run, the others are written by write_conversation_output(sms_sink, call_sink), which returns the
+# number of calls it wrote. Returns the number of calls written in all.
+def write_conversations(render_tasks, render_keys, reused_entries, write_conversation_output, sms_output, call_sink,
+                        checkpoint, render_progress):
+    num_calls = 0
+    for (conversation, own_number), render_key, entry in zip(render_tasks, render_keys, reused_entries):
+        print("Processing " + conversation["path"])
+        sms_sink = roll_sms_part(sms_output, conversation)
+        sms_start, call_start = sms_sink.bytes_written, call_sink.bytes_written
+        if entry:
+            calls = reuse_checkpoint_entry(checkpoint, entry, sms_sink, call_sink)
+        else:
+            calls = write_conversation_output(sms_sink, call_sink)
+        num_calls += calls
+        if checkpoint:
+            add_checkpoint_entry(checkpoint, conversation["path"], render_key, calls,
+                                 (sms_start, sms_sink.bytes_written), (call_start, call_sink.bytes_written),
+                                 len(conversation["messages"]), sms_sink, call_sink)
+        sms_sink.end_conversation()
+        call_sink.end_conversation()
+        update_progress(render_progress, len(conversation["messages"]),
+                        sms_output["bytes_written"] + sms_sink.bytes_written + call_sink.bytes_written)
+    return num_calls
+
+# Function to write the next conversation made ahead in this process
+def render_next_records(records_ahead, attachment_cache, sms_sink, call_sink):
+    return render_records(next(records_ahead), attachment_cache, sms_sink, call_sink)
+
+# Function to write the next conversation rendered by a worker, deleting its spill file once copied, and keep the
+# latest cache stats and metrics of each worker
+def copy_next_fragment(fragments, worker_results, sms_sink, call_sink):
+    fragment = next(fragments)
+    if isinstance(fragment[0], Exception):
+        error, worker_traceback = fragment
+        raise error from WorkerTraceback(worker_traceback)
+    worker_id, sms_output, call_text, calls, cache_stats, metrics = fragment
+    if isinstance(sms_output, bytes):
+        if sms_output:
+            sms_sink.write(sms_output)
+    else:
+        with open(sms_output, "rb") as spill_file:
+            copy_byte_range(spill_file, sms_sink, 0, os.path.getsize(sms_output))
+        os.remove(sms_output)
+    call_sink.write(call_text)
+    worker_results["cache_stats"][worker_id] = cache_stats
+    worker_results["metrics"][worker_id] = metrics
+    return calls
+
+# Function to copy the bytes between two offsets of one file into another, a chunk at a time
+def copy_byte_range(source_file, destination_file, start, end):
+    source_file.seek(start)
+    remaining = end - start
+    while remaining:
+        chunk = source_file.read(min(remaining, ATTACHMENT_CHUNK_SIZE))
+        assert chunk, "Source file ended before the byte range"
+        destination_file.write(chunk)
+        remaining -= len(chunk)
+
+# Function to load the checkpoint manifest of an earlier run, so the conversations it converted can be copied from its
+# output files. The manifest is JSON lines: a header with the choice of what was processed and the output format
+# version, then one entry per converted conversation, pointing at the file and byte range holding its output. Only
+# entries whose bytes are still on disk are kept. Nothing is moved here, that waits for start_checkpoint.
+def load_checkpoint(manifest_filename, call_log_filename):
+    checkpoint = {
+        "manifest_filename": manifest_filename,
+        "process": None,
+        "format": None,
+        "entries": {},  # path -> entry of the earlier run
+        "previous_files": [],  # files set aside for this run to copy from, removed once it finishes
+        "pending": [],  # entries of this run not yet written to the manifest
+        "reused": 0,
+    }
+    if not os.path.exists(manifest_filename):
+        return checkpoint
+
+    with open(manifest_filename, "r", encoding="utf8") as manifest_file:
+        for line in manifest_file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break  # The earlier run stopped while writing this line
+            if "process" in record:
+                checkpoint["process"] = record["process"]
+                checkpoint["format"] = record.get("format")
+            elif "outputs" in record:
+                # A finished run records its output files, so changes to them by another run can be detected
+                if any(get_output_file_stat(output_filename) != output_stat
+                       for output_filename, output_stat in record["outputs"].items()):
+                    print("The output files changed since the checkpoint was made, converting everything again")
+                    checkpoint["entries"].clear()
+                    return checkpoint
+            else:
+                # Manifests written before entries named their call file all point at the call log
+                record.setdefault("call_file", call_log_filename)
+                checkpoint["entries"][record["path"]] = record
+    # The earlier run may have split its messages into several part files, and a resumed run that stopped too points
+    # both at its own output and at what it had not copied yet from the run before. Entries are dropped when their
+    # file is gone, or when it ends before their bytes do, as after a run that stopped before flushing them.
+    output_lengths = {}
+    for entry in checkpoint["entries"].values():
+        for output_filename in (entry["sms_file"], entry["call_file"]):
+            if output_filename not in output_lengths:
+                output_lengths[output_filename] = (get_output_length(output_filename)
+                                                   if os.path.exists(output_filename) else -1)
+    checkpoint["entries"] = {
+        path: entry for path, entry in checkpoint["entries"].items()
+        if entry["sms_offsets"][1] <= output_lengths[entry["sms_file"]]
+        and entry["call_offsets"][1] <= output_lengths[entry["call_file"]]
+    }
+    print(f"Loaded {len(checkpoint['entries'])} converted conversations from {manifest_filename}")
+    return checkpoint
+
+# Function to start this run's manifest, once it is known what is being processed, and set aside the output files
+# of the earlier run before this run clears them. The new manifest takes over the earlier entries, pointing at where
+# their files are moved to, and replaces the old one in a single step before anything is moved. A run that stops at any
+# point leaves a manifest whose entries point at files that are there, or at none, which are then dropped.
+def start_checkpoint(checkpoint, user_confirmation_process):
+    if checkpoint["entries"] and checkpoint["process"] != user_confirmation_process:
+        print("The checkpoint was made with a different choice of what to process, converting everything again")
+        checkpoint["entries"].clear()
+    if checkpoint["entries"] and checkpoint["format"] != OUTPUT_FORMAT_VERSION:
+        print("The checkpoint was made by a version of the script with a different output, converting everything again")
+        checkpoint["entries"].clear()
+    # Output files are moved to the first of *.prev, *.prev2, ... that no entry still points at
+    referenced_filenames = {output_filename for entry in checkpoint["entries"].values()
+                            for output_filename in (entry["sms_file"], entry["call_file"])}
+    moves = {}
+    for output_filename in sorted(referenced_filenames):
+        if not PREVIOUS_SUFFIX_PATTERN.search(output_filename):
+            previous_filename = output_filename + ".prev"
+            number = 2
+            while previous_filename in referenced_filenames:
+                previous_filename = f"{output_filename}.prev{number}"
+                number += 1
+            moves[output_filename] = previous_filename
+    for entry in checkpoint["entries"].values():
+        entry["sms_file"] = moves.get(entry["sms_file"], entry["sms_file"])
+        entry["call_file"] = moves.get(entry["call_file"], entry["call_file"])
+
+    manifest_filename = checkpoint["manifest_filename"]
+    with open(manifest_filename + ".tmp", "w", encoding="utf8") as manifest_file:
+        manifest_file.write(json.dumps({"process": user_confirmation_process, "format": OUTPUT_FORMAT_VERSION}) + "\n")
+        manifest_file.writelines(json.dumps(entry) + "\n" for entry in checkpoint["entries"].values())
+        manifest_file.flush()
+        os.fsync(manifest_file.fileno())
+    os.replace(manifest_filename + ".tmp", manifest_filename)
+    for output_filename, previous_filename in moves.items():
+        os.replace(output_filename, previous_filename)
+
+    checkpoint["previous_files"] = sorted({entry[key] for entry in checkpoint["entries"].values()
+                                           for key in ("sms_file", "call_file")})
+    checkpoint["readers"] = {}
+    checkpoint["file"] = open(manifest_filename, "a", encoding="utf8")
+
+# Function to fingerprint everything a conversation's output depends on: its parsed content, the owner's number,
+# the attachment files its images/videos/vCards map to, and the fallback number for its name. Size and mtime are
+# not enough on their own since a fresh Takeout gives every file a new mtime.
+def get_render_key(conversation, own_number, src_filename_map, fallback_numbers):
+    render_inputs = (
+        conversation,
+        own_number,
+        [src_filename_map.get(src) for src in conversation["srcs"]],
+        find_fallback_number(fallback_numbers, conversation["file"]),
+    )
+    return hashlib.blake2b(repr(render_inputs).encode("utf8"), digest_size=16).hexdigest()
+
+def find_checkpoint_entry(checkpoint, path, render_key):
+    entry = checkpoint["entries"].get(path)
+    return entry if entry and entry["render_key"] == render_key else None
+
+# Function to copy a conversation's output from the earlier run. Returns its number of calls.
+def reuse_checkpoint_entry(checkpoint, entry, sms_sink, call_sink):
+    sms_start, sms_end = entry["sms_offsets"]
+    call_start, call_end = entry["call_offsets"]
+    copy_byte_range(get_checkpoint_reader(checkpoint, entry["sms_file"], sms_start), sms_sink, sms_start, sms_end)
+    copy_byte_range(get_checkpoint_reader(checkpoint, entry["call_file"], call_start), call_sink, call_start, call_end)
+    checkpoint["reused"] += 1
+    return entry["calls"]
+
+# Function to get a reader for an earlier output file. A zstd file can only be read forward, so its reader is reopened
+# when a conversation earlier in the file is wanted.
+def get_checkpoint_reader(checkpoint, previous_filename, start):
+    reader = checkpoint["readers"].get(previous_filename)
+    if isinstance(reader, ZstdOutputReader) and reader.tell() > start:
+        reader.close()
+        reader = None
+    if reader is None:
+        reader = checkpoint["readers"][previous_filename] = open_output_file(previous_filename)
+    return reader
+
+# Function to record a converted conversation. Entries are written in batches, after the output they point to.
+def add_checkpoint_entry(checkpoint, path, render_key, num_calls, sms_offsets, call_offsets, num_messages,
+                         sms_sink, call_sink):
+    size, mtime = get_takeout_file_stat(path)
+    checkpoint["pending"].append({
+        "path": path,
+        "size": size,
+        "mtime": mtime,
+        "messages": num_messages,
+        "calls": num_calls,
+        "render_key": render_key,
+        "sms_file": sms_sink.path,
+        "sms_offsets": sms_offsets,
+        "call_file": call_sink.path,
+        "call_offsets": call_offsets,
+    })
+    if len(checkpoint["pending"]) >= CHECKPOINT_INTERVAL:
+        write_checkpoint(checkpoint, sms_sink, call_sink)
+
+def write_checkpoint(checkpoint, sms_sink, call_sink):
+    # Flush the output first so the manifest never points past what is on disk
+    sms_sink.flush()
+    call_sink.flush()
+    checkpoint["file"].writelines(json.dumps(entry) + "\n" for entry in checkpoint["pending"])
+    checkpoint["file"].flush()
+    checkpoint["pending"].clear()
+
+# Function to close the manifest after a successful run and remove the earlier runs' output files
+def close_checkpoint(checkpoint, output_filenames):
+    checkpoint["file"].write(json.dumps(
+        {"outputs": {output_filename: get_output_file_stat(output_filename) for output_filename in output_filenames}}
+    ) + "\n")
+    checkpoint["file"].close()
+    for reader in checkpoint["readers"].values():
+        reader.close()
+    for previous_filename in checkpoint["previous_files"]:
+        os.remove(previous_filename)
+
+def get_output_file_stat(output_filename):
+    if not os.path.exists(output_filename):
+        return None
+    file_stat = os.stat(output_filename)
+    return [file_stat.st_size, file_stat.st_mtime_ns]
+
+# Function to merge the files and Takeouts given with --merge into the SMS and calls output files. Records are copied
+# from the earlier files in the order given, skipping any message or call whose key is already in the index.
+def merge_outputs(args):
+    output_filenames = {"smses": [], "calls": []}
+    sms_log_filename = args.sms_output + COMPRESSION_SUFFIXES[args.compress]
+    call_log_filename = args.calls_output + COMPRESSION_SUFFIXES[args.compress]
+    with TemporaryDirectory(dir=os.path.dirname(os.path.abspath(sms_log_filename))) as convert_dir:
+        for input_number, input_path in enumerate(args.merge):
+            output_kind = get_output_kind(input_path)
+            if output_kind:
+                output_filenames[output_kind].append(input_path)
+                continue
+            # Anything else is a Takeout, converted in full into the temporary folder with this run's options
+            print("Converting " + input_path + " to merge it")
+            converted_sms = os.path.join(convert_dir, f"sms-{input_number}.xml")
+            converted_calls = os.path.join(convert_dir, f"calls-{input_number}.xml")
+            convert_options = [
+                "--input", input_path, "--process", "both", "--cleanup", "keep",
+                "--sms-output", converted_sms, "--calls-output", converted_calls,
+                "--jobs", str(args.jobs), "--parser", args.parser, "--attachment-cache-mb", str(args.attachment_cache_mb),
+                "--prefetch-threads", str(args.prefetch_threads), "--prefetch-mb", str(args.prefetch_mb),
+                "--output-buffer-mb", str(args.output_buffer_mb), "--compress", args.compress,
+            ]
+            if args.attachment_cache_dir:
+                convert_options += ["--attachment-cache-dir", args.attachment_cache_dir]
+            with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                main(convert_options)
+            output_filenames["smses"].append(converted_sms + COMPRESSION_SUFFIXES[args.compress])
+            output_filenames["calls"].append(converted_calls + COMPRESSION_SUFFIXES[args.compress])
+
+        for output_kind, merged_filename in (("smses", sms_log_filename), ("calls", call_log_filename)):
+            merge_output_files(output_filenames[output_kind], output_kind, merged_filename,
+                               args.output_buffer_mb * 1024 * 1024, args.fsync, args.compress)
+            if args.sort_by_date:
+                sort_output_file(merged_filename, args.sort_buffer_mb * 1024 * 1024,
+                                 args.output_buffer_mb * 1024 * 1024, args.fsync, args.compress)
+
+# Function to tell whether a file is an SMS or calls output file, from the root element in its first bytes
+def get_output_kind(input_path):
+    if not os.path.isfile(input_path) or is_zipfile(input_path) or tarfile.is_tarfile(input_path):
+        return None
+    output_file = open_output_file(input_path)
+    try:
+        head = output_file.read(512)
+    except (OSError, EOFError, zlib.error) + ((zstandard.ZstdError,) if zstandard else ()):
+        return None
+    finally:
+        output_file.close()
+    for output_kind in ("smses", "calls"):
+        if f"<{output_kind} ".encode("ascii") in head:
+            return output_kind
+    return None
+
+def merge_output_files(input_filenames, output_kind, merged_filename, buffer_size, fsync_policy, compression):
+    format_header = format_sms_header if output_kind == "smses" else format_calls_header
+    merged_sink = OutputSink(merged_filename, buffer_size, fsync_policy, compression)
+    header_offset = merged_sink.reserve(format_header(0))
+    dedup_index = new_dedup_index()
+    num_records = 0
+    num_duplicates = 0
+    for input_filename in input_filenames:
+        # Find the records to keep in one pass, then copy them over in a second one
+        kept_ranges = []
+        input_file = open_output_file(input_filename)
+        for start, end, key_hash in iter_output_records(input_file):
+            if not add_to_dedup_index(dedup_index, key_hash):
+                num_duplicates += 1
+                continue
+            num_records += 1
+            if kept_ranges and kept_ranges[-1][1] == start:
+                kept_ranges[-1][1] = end
+            else:
+                kept_ranges.append([start, end])
+        input_file.close()
+        input_file = open_output_file(input_filename)
+        for start, end in kept_ranges:
+            copy_byte_range(input_file, merged_sink, start, end)
+        input_file.close()
+    merged_sink.write(f"</{output_kind}>")
+    merged_sink.close()
+    merged_sink.patch(header_offset, format_header(num_records))
+    print(f"Merged {num_records} {'messages' if output_kind == 'smses' else 'calls'} from {len(input_filenames)} "
+          f"files into {merged_filename}, skipped {num_duplicates} duplicates")
+
+# Function to find the messages and calls in an output file, yielding the byte range and key hash of each. A message
+# is keyed on its address, date, type and text, an MMS on its addresses, date and box plus a digest of the text and
+# data of all its parts, and a call on its number, date, duration and type.
+def iter_output_records(output_file):
+    offset = 0
+    at_line_start = True
+    record = None  # start offset and pieces of the SMS or call being read
+    mms = None  # start offset and running hash of the MMS being read
+    for piece in iter_output_pieces(output_file):
+        piece_start = offset
+        offset += len(piece)
+        if record:
+            record["pieces"].append(piece)
+        elif mms:
+            if at_line_start and piece.startswith(b"</mms>"):
+                yield mms["start"], offset, get_key_hash(mms["hash"])
+                mms = None
+            elif at_line_start and piece.lstrip().startswith(b"<part "):
+                # From the text attribute on, leaving out the part's file name
+                mms["hash"].update(piece[piece.find(b' text="'):])
+            else:
+                # Attachment data, addresses, and the lines of a text with line breaks
+                mms["hash"].update(piece)
+        elif at_line_start and piece.startswith((b"<sms ", b"<call ")):
+            record = {"start": piece_start, "pieces": [piece]}
+        elif at_line_start and piece.startswith(b"<mms "):
+            attributes = dict(RECORD_ATTRIBUTE_PATTERN.findall(piece))
+            key = b"\0".join([b"mms", *(attributes.get(name, b"") for name in (b"address", b"date", b"msg_box"))])
+            mms = {"start": piece_start, "hash": hashlib.blake2b(key, digest_size=8)}
+        at_line_start = piece.endswith(b"\n")
+        if record and is_record_end_line(piece):
+            record_text = b"".join(record["pieces"])
+            attributes = dict(RECORD_ATTRIBUTE_PATTERN.findall(record_text))
+            key_names = (b"address", b"date", b"type", b"body") if record_text.startswith(b"<sms ") else \
+                (b"number", b"date", b"duration", b"type")
+            key = b"\0".join([record_text[1:record_text.index(b" ")],
+                              *(attributes.get(name, b"") for name in key_names)])
+            yield record["start"], offset, get_key_hash(hashlib.blake2b(key, digest_size=8))
+            record = None
+
+# Function to tell whether a piece ends an SMS or call. A message body can have line breaks of its own, but never a
+# ">" since that is escaped, so the record ends with the line that closes its tag.
+def is_record_end_line(piece):
+    return piece.endswith(b"\n") and piece.rstrip().endswith(b"/>")
+
+# Function to read a file as lines, except that lines longer than a chunk, like attachment data, come in pieces of at
+# least a chunk
+def iter_output_pieces(output_file):
+    buffer = b""
+    while chunk := output_file.read(ATTACHMENT_CHUNK_SIZE):
+        buffer += chunk
+        line_start = 0
+        while (line_end := buffer.find(b"\n", line_start)) != -1:
+            yield buffer[line_start:line_end + 1]
+            line_start = line_end + 1
+        buffer = buffer[line_start:]
+        if len(buffer) >= ATTACHMENT_CHUNK_SIZE:
+            yield buffer
+            buffer = b""
+    if buffer:
+        yield buffer
+
+# Key hashes are 64-bit integers, 0 marks an empty slot of the index
+def get_key_hash(key_hash):
+    return int.from_bytes(key_hash.digest(), "little") or 1
+
+# Function to create the index of the records merged so far: an open-addressing hash set of 64-bit key hashes packed
+# into an array, which takes 16 to 32 bytes per record however long the records are
+def new_dedup_index():
+    return {"slots": array("Q", bytes(8 * DEDUP_INDEX_INITIAL_SLOTS)), "count": 0}
+
+# Function to add a key hash to the index, returning False if it was already there
+def add_to_dedup_index(dedup_index, key_hash):
+    slots = dedup_index["slots"]
+    mask = len(slots) - 1
+    position = key_hash & mask
+    while slots[position]:
+        if slots[position] == key_hash:
+            return False
+        position = (position + 1) & mask
+    slots[position] = key_hash
+    dedup_index["count"] += 1
+    # Keep the index at most half full so probes stay short
+    if dedup_index["count"] * 2 > len(slots):
+        dedup_index["slots"] = array("Q", bytes(16 * len(slots)))
+        dedup_index["count"] = 0
+        for old_key_hash in slots:
+            if old_key_hash:
+                add_to_dedup_index(dedup_index, old_key_hash)
+    return True
+
+# Function to rewrite an output file with its records in date order, records with the same date keeping their order.
+# This is an external merge sort: the records are cut into runs of up to run_bytes, each sorted in memory and written
+# to a temporary file, and the runs are then merged, so outputs of any size are sorted in bounded memory.
+def sort_output_file(filename, run_bytes, buffer_size, fsync_policy, compression):
+    directory, basename = os.path.split(os.path.abspath(filename))
+    # Same suffix as the output, so the sorted file is written the same way
+    sorted_filename = os.path.join(directory, ".sorting-" + basename)
+    with TemporaryDirectory(dir=directory) as run_dir:
+        head, tail, run_filenames, num_records = write_sorted_runs(filename, run_dir, run_bytes)
+        num_runs = len(run_filenames)
+        # At most SORT_MAX_FAN_IN runs are open at once, each read through an equal share of the sort buffer, so
+        # neither open files nor memory grow with the output. More runs are merged into longer ones first.
+        read_buffer_size = max(run_bytes // SORT_MAX_FAN_IN, DEFAULT_BUFFER_SIZE)
+        num_passes = 1
+        while len(run_filenames) > SORT_MAX_FAN_IN:
+            merged_filenames = []
+            for group_start in range(0, len(run_filenames), SORT_MAX_FAN_IN):
+                group = run_filenames[group_start:group_start + SORT_MAX_FAN_IN]
+                if len(group) == 1:
+                    merged_filenames.append(group[0])
+                    continue
+                merged_filename = os.path.join(run_dir, f"merged-{num_passes}-{len(merged_filenames)}")
+                with open(merged_filename, "wb", buffering=read_buffer_size) as merged_file:
+                    merge_runs(group, merged_file, read_buffer_size, True)
+                for run_filename in group:
+                    os.remove(run_filename)
+                merged_filenames.append(merged_filename)
+            run_filenames = merged_filenames
+            num_passes += 1
+        sorted_sink = OutputSink(sorted_filename, buffer_size, fsync_policy, compression)
+        sorted_sink.write(head)
+        merge_runs(run_filenames, sorted_sink, read_buffer_size, False)
+        sorted_sink.write(tail)
+        sorted_sink.close()
+    os.replace(sorted_filename, filename)
+    print(f"Sorted {num_records} records of {filename} by date in {num_runs} runs and {num_passes} merge passes")
+
+# Function to write the records of an output file to run files, each sorted by date. Records are kept in memory until
+# they add up to run_bytes, except a record that is larger on its own, which is streamed to a run of its own as it is
+# read. Returns the bytes before the first record and after the last, the run files and the number of records.
+def write_sorted_runs(filename, run_dir, run_bytes):
+    head = []
+    tail = []
+    run_filenames = []
+    run = []  # (date, position, pieces) of the records of the run being collected
+    run_size = 0
+    record = None  # The record being read
+    large_record_file = None
+    num_records = 0
+    at_line_start = True
+    output_file = open_output_file(filename)
+    for piece in iter_output_pieces(output_file):
+        if record is None:
+            if at_line_start and piece.startswith((b"<sms ", b"<call ", b"<mms ")):
+                record = {
+                    "date": int(dict(RECORD_ATTRIBUTE_PATTERN.findall(piece)).get(b"date", 0)),
+                    "position": num_records,
+                    "pieces": [],
+                    "size": 0,
+                    "is_mms": piece.startswith(b"<mms "),
+                }
+                num_records += 1
+            else:
+                (tail if num_records else head).append(piece)
+                at_line_start = piece.endswith(b"\n")
+                continue
+        if large_record_file:
+            large_record_file.write(piece)
+        else:
+            record["pieces"].append(piece)
+        record["size"] += len(piece)
+        if record["size"] > run_bytes and not large_record_file:
+            large_record_file = open(os.path.join(run_dir, f"run-{len(run_filenames)}"), "wb")
+            run_filenames.append(large_record_file.name)
+            large_record_file.write(SORT_RECORD_HEADER.pack(record["date"], record["position"], 0))
+            large_record_file.writelines(record["pieces"])
+            record["pieces"] = None
+        # An SMS or call ends with the line closing its tag, an MMS with its </mms> line
+        if record["is_mms"]:
+            is_record_end = piece.startswith(b"</mms>") and piece.endswith(b"\n")
+        else:
+            is_record_end = is_record_end_line(piece)
+        at_line_start = piece.endswith(b"\n")
+        if not is_record_end:
+            continue
+        if large_record_file:
+            # The length goes in the header once it is known
+            large_record_file.seek(0)
+            large_record_file.write(SORT_RECORD_HEADER.pack(record["date"], record["position"], record["size"]))
+            large_record_file.close()
+            large_record_file = None
+        else:
+            run.append((record["date"], record["position"], record["pieces"]))
+            run_size += record["size"]
+            if run_size >= run_bytes:
+                write_run(run, run_dir, run_filenames)
+                run = []
+                run_size = 0
+        record = None
+    output_file.close()
+    assert record is None, f"{filename} ends in the middle of a record"
+    if run:
+        write_run(run, run_dir, run_filenames)
+    return b"".join(head), b"".join(tail), run_filenames, num_records
+
+def write_run(run, run_dir, run_filenames):
+    run.sort(key=lambda record: record[:2])
+    with open(os.path.join(run_dir, f"run-{len(run_filenames)}"), "wb") as run_file:
+        for date, position, pieces in run:
+            run_file.write(SORT_RECORD_HEADER.pack(date, position, sum(map(len, pieces))))
+            run_file.writelines(pieces)
+        run_filenames.append(run_file.name)
+
+# Function to merge sorted run files by date, writing the records to a longer run with their headers, or to the
+# sorted output without them
+def merge_runs(run_filenames, destination, read_buffer_size, keep_headers):
+    run_files = [open(run_filename, "rb", buffering=read_buffer_size) for run_filename in run_filenames]
+    # Each run yields the key of its next record, whose bytes are copied before the run is read any further
+    for date, position, length, run_file in heapq.merge(*map(iter_run_records, run_files)):
+        if keep_headers:
+            destination.write(SORT_RECORD_HEADER.pack(date, position, length))
+        start = run_file.tell()
+        copy_byte_range(run_file, destination, start, start + length)
+    for run_file in run_files:
+        run_file.close()
+
+# Function to go over the records of a run file, yielding the date, position and length of each along with the file,
+# positioned at the record's bytes
+def iter_run_records(run_file):
+    while header := run_file.read(SORT_RECORD_HEADER.size):
+        yield (*SORT_RECORD_HEADER.unpack(header), run_file)
+
+# Function to parse --input into an SQLite store of its records, inserted in output order so an unfiltered
+# --from-store writes the same messages and calls as a conversion
+def save_store(args):
+    if os.path.exists(args.save_store):
+        os.remove(args.save_store)
+    connection = sqlite3.connect(args.save_store)
+    # The store can always be made again from the Takeout, so it is written without a journal
+    connection.execute("PRAGMA journal_mode = OFF")
+    connection.execute("PRAGMA synchronous = OFF")
+    connection.executescript(STORE_SCHEMA)
+    store = {"connection": connection, "messages": [], "addrs": [], "attachments": [], "calls": [],
+             "counts": Counter(), "root_path": None}
+    start = perf_counter()
+    for record in iter_records(args.input, args.process or "both", args.parser, args.jobs or os.cpu_count()):
+        if isinstance(record, Call):
+            store["calls"].append((None, record.number, record.date, record.duration, record.type))
+            store["counts"]["calls"] += 1
+        else:
+            message_id = store["counts"]["sms"] + store["counts"]["mms"] + 1
+            if isinstance(record, Sms):
+                store["messages"].append((message_id, "sms", record.address, record.date, record.type, None,
+                                          None, record.body, None))
+                store["counts"]["sms"] += 1
+            else:
+                store["messages"].append((message_id, "mms", record.address, record.date, record.msg_box,
+                                          record.m_type, record.text_only, record.text, record.tr_id))
+                store["addrs"].extend((message_id, seq, number, code) for seq, (number, code) in enumerate(record.addrs))
+                for seq, attachment in enumerate(record.attachments):
+                    store["attachments"].append((message_id, seq, attachment.content_type, attachment.name,
+                                                 attachment.get_size()))
+                    store["root_path"] = str(attachment.root_path)
+                store["counts"]["mms"] += 1
+        if len(store["messages"]) + len(store["calls"]) >= STORE_BATCH_SIZE:
+            flush_store(store)
+    flush_store(store)
+    archive = os.path.abspath(args.input) if os.path.isfile(args.input) else ""
+    connection.executemany("INSERT INTO meta VALUES (?, ?)", [("archive", archive),
+                                                              ("root_path", store["root_path"] or ".")])
+    connection.executescript(STORE_INDEXES)
+    connection.commit()
+    connection.close()
+    counts = store["counts"]
+    print(f"Saved {counts['sms']} SMS, {counts['mms']} MMS and {counts['calls']} calls to {args.save_store} "
+          f"in {perf_counter() - start:.2f}s")
+
+def flush_store(store):
+    connection = store["connection"]
+    connection.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", store["messages"])
+    connection.executemany("INSERT INTO addrs VALUES (?, ?, ?, ?)", store["addrs"])
+    connection.executemany("INSERT INTO attachments VALUES (?, ?, ?, ?, ?)", store["attachments"])
+    connection.executemany("INSERT INTO calls VALUES (?, ?, ?, ?, ?)", store["calls"])
+    for rows in ("messages", "addrs", "attachments", "calls"):
+        store[rows].clear()
+
+# Function to write the SMS and calls XML from a store made by --save-store, streaming the selected rows in the
+# order they were saved
+def render_store(args):
+    connection = sqlite3.connect(args.from_store)
+    meta = dict(connection.execute("SELECT key, value FROM meta"))
+    if meta["archive"]:
+        use_takeout_archive(index_takeout_archive(meta["archive"], False)["archive"])
+        root_path = PurePosixPath(meta["root_path"])
+    else:
+        root_path = Path(meta["root_path"])
+    message_filter, message_parameters, call_filter, call_parameters = get_store_filters(args)
+    # Rows were saved in conversion order, and the date index sorts them by date instead
+    order = "date, id" if args.sort_by_date else "id"
+    buffer_size = args.output_buffer_mb * 1024 * 1024
+    start = perf_counter()
+
+    # Only the files of the selected record types are written, the other one is left alone
+    if "sms" in args.record_types or "mms" in args.record_types:
+        sms_log_filename = args.sms_output + COMPRESSION_SUFFIXES[args.compress]
+        sms_sink = OutputSink(sms_log_filename, buffer_size, args.fsync, args.compress)
+        num_messages = 0
+        header_offset = write_sms_header(sms_sink)
+        attachment_cache = new_attachment_cache(
+            args.attachment_cache_mb * 1024 * 1024, None,
+            get_shared_sizes(size for size, in connection.execute("SELECT size FROM attachments")),
+            {root_path / name for name, in connection.execute(
+                "SELECT name FROM attachments GROUP BY name HAVING COUNT(*) > 1")},
+            get_prefetch_threads(args.prefetch_threads, meta["archive"]), args.prefetch_mb * 1024 * 1024)
+        records_ahead = prefetch_ahead(([record] for record in iter_store_messages(
+            connection, message_filter, message_parameters, order, root_path)), attachment_cache)
+        for records in records_ahead:
+            num_messages += len(records)
+            render_records(records, attachment_cache, sms_sink, None)
+        close_attachment_cache(attachment_cache)
+        sms_sink.write("</smses>")
+        sms_sink.close()
+        sms_sink.patch(header_offset, format_sms_header(num_messages))
+        print(f"Wrote {num_messages} messages to {sms_log_filename}")
+
+    if "calls" in args.record_types:
+        call_log_filename = args.calls_output + COMPRESSION_SUFFIXES[args.compress]
+        call_sink = OutputSink(call_log_filename, buffer_size, args.fsync, args.compress)
+        num_calls = 0
+        header_offset = write_calls_header(call_sink)
+        for row in connection.execute(f"SELECT number, date, duration, type FROM calls WHERE {call_filter} "
+                                      f"ORDER BY {order}", call_parameters):
+            write_call(Call(*row), call_sink)
+            num_calls += 1
+        call_sink.write("</calls>")
+        call_sink.close()
+        call_sink.patch(header_offset, format_calls_header(num_calls))
+        print(f"Wrote {num_calls} calls to {call_log_filename}")
+    connection.close()
+    close_takeout_archive()
+    print(f"Wrote the XML from {args.from_store} in {perf_counter() - start:.2f}s")
+
+# Function to build the WHERE clauses and parameters for the messages and calls selected by the filter options
+def get_store_filters(args):
+    message_conditions = [f"kind IN ({', '.join('?' * len(args.record_types))})"]
+    message_parameters = list(args.record_types)
+    call_conditions = ["1"]
+    call_parameters = []
+    if args.contact:
+        # Numbers are saved in E.164 where they parse, so both the given and the normalized form are looked up
+        numbers = list({args.contact, normalize_number(args.contact) or args.contact})
+        placeholders = ", ".join("?" * len(numbers))
+        message_conditions.append(f"(address IN ({placeholders}) OR "
+                                  f"id IN (SELECT message_id FROM addrs WHERE number IN ({placeholders})))")
+        message_parameters += numbers * 2
+        call_conditions.append(f"number IN ({placeholders})")
+        call_parameters += numbers
+    for option, operator in ((args.since, ">="), (args.before, "<")):
+        if option:
+            message_conditions.append(f"date {operator} ?")
+            message_parameters.append(get_time_unix_iso(option))
+            call_conditions.append(f"date {operator} ?")
+            call_parameters.append(get_time_unix_iso(option))
+    return " AND ".join(message_conditions), message_parameters, " AND ".join(call_conditions), call_parameters
+
+# Function to make Sms and Mms records from the selected rows of the store. The rows are streamed from a cursor, and
+# each MMS looks up its addresses and attachments by primary key.
+def iter_store_messages(connection, message_filter, message_parameters, order, root_path):
+    rows = connection.execute("SELECT id, kind, address, date, type, m_type, text_only, body, tr_id FROM messages "
+                              f"WHERE {message_filter} ORDER BY {order}", message_parameters)
+    for message_id, kind, address, date, message_type, m_type, text_only, body, tr_id in rows:
+        if kind == "sms":
+            yield Sms(address, date, message_type, body)
+            continue
+        addrs = connection.execute("SELECT number, code FROM addrs WHERE message_id = ? ORDER BY seq",
+                                   (message_id,)).fetchall()
+        attachments = [
+            Attachment(content_type, root_path / name, root_path)
+            for content_type, name in connection.execute(
+                "SELECT content_type, name FROM attachments WHERE message_id = ? ORDER BY seq", (message_id,))
+        ]
+        yield Mms(address, date, m_type, message_type, text_only, body, attachments, addrs, tr_id)
 
 # Function to find the calls folder
 def find_calls_folder(start_dir='.'):
@@ -145,33 +1623,42 @@ def find_calls_folder(start_dir='.'):
             return os.path.join(root, 'Calls')
     return None
 
-# Function for user to define scope (calls and sms), and opt to remove conversations that won't convert
-def user_setup():
-    # Prompt for what to process
-    print("\nChoose what to process:")
-    print("1. SMS only")
-    print("2. Calls only")
-    print("3. Both SMS and Calls")
-    user_confirmation_process = input("Enter 1, 2, or 3: ").strip()
-    while user_confirmation_process not in ('1', '2', '3'):
-        user_confirmation_process = input("Invalid choice. Enter 1, 2, or 3: ").strip()
-
-    # Prompt for user confirmation before deleting files
-    user_confirmation_delete = input("""
+# Function for user to define scope (calls and sms), and opt to remove conversations that won't convert.
+# Choices already made on the command line are not asked for, so a run with both of them is unattended.
+def user_setup(process_choice=None, cleanup_choice=None, root_dir='.'):
+    if process_choice:
+        user_confirmation_process = PROCESS_CHOICES[process_choice]
+    else:
+        # Prompt for what to process
+        print("\nChoose what to process:")
+        print("1. SMS only")
+        print("2. Calls only")
+        print("3. Both SMS and Calls")
+        user_confirmation_process = input("Enter 1, 2, or 3: ").strip()
+        while user_confirmation_process not in ('1', '2', '3'):
+            user_confirmation_process = input("Invalid choice. Enter 1, 2, or 3: ").strip()
+
+    if cleanup_choice:
+        should_delete = cleanup_choice == "remove"
+    else:
+        # Prompt for user confirmation before deleting files
+        user_confirmation_delete = input("""
 Would you like to automatically remove conversations that won't convert?
 This is conversations without attached phone numbers, ones with shortcode phone numbers, or things like missed calls and voicemails.
 If you say yes, this will automatically delete those files before converting.
 (Y/N)? """).strip().lower()
-    
-    # Store boolean for deletion choice
-    should_delete = user_confirmation_delete in ('y', '')
+
+        # Store boolean for deletion choice
+        should_delete = user_confirmation_delete in ('y', '')
 
     # Gate file deletion based on should_delete
-    if should_delete:
+    if should_delete and os.path.isfile(root_dir):
+        print("Reading from an archive, conversations that won't convert will be skipped instead of deleted.")
+    elif should_delete:
         print("Running file/conversation deletion logic...")
         
         # Find files starting with " -" instead of a phone number
-        calls_path = find_calls_folder()
+        calls_path = find_calls_folder(root_dir)
         if calls_path:
             print(f"Found 'Calls' folder at: {calls_path}")
             
@@ -214,32 +1701,431 @@ def escape_xml(s):
             .replace("'", "&apos;")
             .replace('"', "&quot;"))
 
-# Function to extract img src from HTML files
-def extract_src(html_directory):
-    src_list = []
-    for html_file in Path(html_directory).rglob('*.html'):  # Assuming HTML files have .html extension
-        with open(html_file, 'r', encoding='utf-8') as file:
-            soup = BeautifulSoup(file, 'html.parser')
-            src_list.extend([img['src'] for img in soup.find_all('img') if 'src' in img.attrs])
-            src_list.extend([a['href'] for a in soup.find_all('a', class_='video') if 'href' in a.attrs])
-            src_list.extend([a['href'] for a in soup.find_all('a', class_='vcard') if 'href' in a.attrs])
-    return src_list
-
-# Function to list attachment filenames with specific extensions
-def list_att_filenames(image_directory):
-    return [str(path.name) for path in Path(image_directory).rglob('*') 
-            if path.suffix.lower() in ALLOWED_EXTENSIONS]
+# Function to walk the Takeout folder once, recording conversation files and attachments with their sizes.
+# Attachment paths are resolved against base_path, and named in the output relative to root_path.
+def index_takeout(root_dir, skip_unconvertible=False):
+    if os.path.isfile(root_dir):
+        return index_takeout_archive(root_dir, skip_unconvertible)
+    html_files = []
+    attachments = {}
+    for subdir, dirs, files in os.walk(root_dir):
+        for file in files:
+            file_path = os.path.join(subdir, file)
+            if os.path.splitext(file)[1] == ".html":
+                html_files.append(file_path)
+            elif Path(file).suffix.lower() in ALLOWED_EXTENSIONS:
+                attachments[file_path] = os.path.getsize(file_path)
+    return {"html_files": html_files, "attachments": attachments, "archive": None,
+            "base_path": Path.cwd(), "root_path": Path.cwd() / root_dir}
+
+# Function to index the members of a Takeout .zip or .tar(.gz) archive the same way, without extracting it.
+# Conversations that user_setup would delete from a folder are skipped instead.
+def index_takeout_archive(archive_path, skip_unconvertible):
+    if is_zipfile(archive_path):
+        with ZipFile(archive_path) as archive:
+            members = {str(PurePosixPath(info.filename)): info for info in archive.infolist() if not info.is_dir()}
+    else:
+        with tarfile.open(archive_path) as archive:
+            members = {str(PurePosixPath(member.name)): member for member in archive if member.isfile()}
+
+    html_files = []
+    attachments = {}
+    for member_name, member in members.items():
+        file = PurePosixPath(member_name).name
+        if skip_unconvertible and is_unconvertible_member(member_name):
+            continue
+        if os.path.splitext(file)[1] == ".html":
+            html_files.append(member_name)
+        elif Path(file).suffix.lower() in ALLOWED_EXTENSIONS:
+            attachments[member_name] = member.file_size if isinstance(member, ZipInfo) else member.size
+    return {"html_files": html_files, "attachments": attachments, "archive": (archive_path, members),
+            "base_path": PurePosixPath(), "root_path": PurePosixPath()}
+
+# Function to check an archive member against the same rules user_setup deletes files in the Calls folder by:
+# no number (" -...") or a shortcode number
+def is_unconvertible_member(member_name):
+    member_path = PurePosixPath(member_name)
+    return member_path.parent.name == "Calls" and (
+        member_path.name.startswith(" -") or re.match(r'^[0-9]{1,8}.*$', member_path.name) is not None
+    )
+
+# Takeout archive that files are read from instead of the file system. Each process opens its own handle to it on
+# first use, since a handle inherited from the parent process shares its file position. Prefetch threads read from
+# the same handle, so opening it is locked.
+takeout_archive = {}
+takeout_archive_lock = threading.Lock()
+
+def use_takeout_archive(archive):
+    close_takeout_archive()
+    if archive:
+        takeout_archive["path"], takeout_archive["members"] = archive
+
+def close_takeout_archive():
+    if takeout_archive.get("pid") == os.getpid():
+        takeout_archive["handle"].close()
+    takeout_archive.clear()
+
+# Function to open a Takeout file for reading in binary mode, from the archive if there is one
+def open_takeout_file(path):
+    if not takeout_archive:
+        return open(path, "rb")
+    with takeout_archive_lock:
+        if takeout_archive.get("pid") != os.getpid():
+            archive_path = takeout_archive["path"]
+            takeout_archive["handle"] = ZipFile(archive_path) if is_zipfile(archive_path) else tarfile.open(archive_path)
+            takeout_archive["pid"] = os.getpid()
+    member = takeout_archive["members"][str(path)]
+    if isinstance(member, ZipInfo):
+        return takeout_archive["handle"].open(member)
+    return takeout_archive["handle"].extractfile(member)
+
+# Function to get the size and modification time of a Takeout file, from the archive if there is one
+def get_takeout_file_stat(path):
+    if not takeout_archive:
+        file_stat = os.stat(path)
+        return file_stat.st_size, file_stat.st_mtime
+    member = takeout_archive["members"][str(path)]
+    if isinstance(member, ZipInfo):
+        return member.file_size, datetime(*member.date_time).timestamp()
+    return member.size, member.mtime
+
+def get_takeout_file_size(path):
+    if not takeout_archive:
+        return os.path.getsize(path)
+    member = takeout_archive["members"][str(path)]
+    return member.file_size if isinstance(member, ZipInfo) else member.size
+
+# Function to parse a conversation HTML file once into the plain records the writers need
+def parse_conversation(sms_filename):
+    with TextIOWrapper(open_takeout_file(sms_filename), encoding="utf8") as sms_file:
+        soup = BeautifulSoup(sms_file, "html.parser")
+
+    # img src elements first, then videos, then vCards, matching the order attachments are mapped in
+    srcs = [img['src'] for img in soup.find_all('img') if 'src' in img.attrs]
+    srcs.extend([a['href'] for a in soup.find_all('a', class_='video') if 'href' in a.attrs])
+    srcs.extend([a['href'] for a in soup.find_all('a', class_='vcard') if 'href' in a.attrs])
+
+    # The <abbr class="fn"> tags are only needed up to the first "Me" with a phone number
+    fn_abbrs = []
+    for abbr_tag in soup.find_all('abbr', class_='fn'):
+        is_me = abbr_tag.get_text(strip=True) == "Me"
+        a_tag = abbr_tag.find_previous('a', class_='tel') if is_me else None
+        fn_abbrs.append((is_me, a_tag.get('href') if a_tag else None))
+        if a_tag:
+            break
+
+    participants = [
+        [participant.a["href"][4:] for participant in participant_set if hasattr(participant, "a")]
+        for participant_set in soup.find_all(class_="participants")
+    ]
+
+    call_raw = soup.find(class_="haudio")
+
+    return {
+        "path": sms_filename,
+        "file": os.path.basename(sms_filename),
+        "srcs": srcs,
+        "fn_abbrs": fn_abbrs,
+        "participants": participants,
+        "messages": [get_message_record(message) for message in soup.find_all(class_="message")],
+        "contributors": [contrib_vcard.a["href"][4:] for contrib_vcard in soup.find_all(class_="contributor vcard")],
+        "call": get_call_record(call_raw) if call_raw else None,
+    }
+
+def get_message_record(message):
+    sender_data = message.cite
+    return {
+        "type": get_message_type(message),
+        "has_span": bool(message.span),
+        "sender_name": sender_data.text,
+        "sender": sender_data.a["href"][4:],
+        "text": get_message_text(message),
+        "time": get_time_unix(message),
+        "images": [image["src"] for image in message.find_all("img")],
+        "videos": [video.get("href") for video in message.find_all("a", class_='video')],
+        "vcards": [vcard.get("href") for vcard in message.find_all("a", class_='vcard')],
+    }
+
+def get_call_record(call_raw):
+    duration_element = call_raw.find(class_='duration')
+    return {
+        "number": call_raw.find('a', class_='tel').get('href').split(':', 1)[-1],
+        "date": get_time_unix_call(call_raw),
+        "duration": duration_element['title'] if duration_element else "PT0S",
+        "tags": [tag.get_text(strip=True) for tag in call_raw.find_all('a', rel='tag')],
+    }
+
+# Functions to parse only the call of a file, for runs that convert calls alone. Files named as text threads are
+# skipped without being read, and any other file without a "haudio" block is skipped without being parsed. The
+# records have the same call as a full parse and no messages.
+def parse_call(sms_filename):
+    call_markup = read_call_markup(sms_filename)
+    if call_markup is None:
+        return new_call_only_record(sms_filename, None)
+    soup = BeautifulSoup(call_markup, "html.parser", parse_only=SoupStrainer(class_="haudio"), from_encoding="utf8")
+    call_raw = soup.find(class_="haudio")
+    return new_call_only_record(sms_filename, get_call_record(call_raw) if call_raw else None)
+
+def parse_call_lxml(sms_filename):
+    call_markup = read_call_markup(sms_filename)
+    if call_markup is None:
+        return new_call_only_record(sms_filename, None)
+    root = etree.fromstring(call_markup, etree.HTMLParser(encoding="utf-8"))
+    call_raw = None
+    if root is not None:
+        call_raw = next((element for element in root.iter(etree.Element)
+                         if "haudio" in element.get("class", "").split()), None)
+    return new_call_only_record(sms_filename, get_call_record_lxml(call_raw) if call_raw is not None else None)
+
+def read_call_markup(sms_filename):
+    file = os.path.basename(sms_filename)
+    if TEXT_THREAD_FILENAME_PATTERN.search(file) or file.startswith("Group Conversation"):
+        return None
+    with open_takeout_file(sms_filename) as sms_file:
+        call_markup = sms_file.read()
+    return call_markup if b"haudio" in call_markup else None
+
+def new_call_only_record(sms_filename, call):
+    return {
+        "path": sms_filename,
+        "file": os.path.basename(sms_filename),
+        "srcs": [],
+        "fn_abbrs": [],
+        "participants": [],
+        "messages": [],
+        "contributors": [],
+        "call": call,
+    }
+
+# Function to parse a conversation HTML file with lxml into the same records as parse_conversation. The tree is
+# walked once in document order, and nothing is converted to a BeautifulSoup tree.
+def parse_conversation_lxml(sms_filename):
+    with open_takeout_file(sms_filename) as sms_file:
+        markup = sms_file.read()
+    if has_repeated_attribute(markup):
+        return parse_conversation(sms_filename)
+    root = etree.fromstring(markup, etree.HTMLParser(encoding="utf-8"))
+
+    img_srcs = []
+    video_srcs = []
+    vcard_srcs = []
+    fn_abbrs = []
+    fn_abbrs_done = False
+    last_tel = None
+    participants = []
+    messages = []
+    contributors = []
+    call_raw = None
+    for element in root.iter(etree.Element) if root is not None else ():
+        tag = element.tag
+        classes = element.get("class", "").split()
+        if tag == "img" and "src" in element.attrib:
+            img_srcs.append(element.get("src"))
+        elif tag == "a":
+            if "tel" in classes:
+                last_tel = element
+            if "video" in classes and "href" in element.attrib:
+                video_srcs.append(element.get("href"))
+            if "vcard" in classes and "href" in element.attrib:
+                vcard_srcs.append(element.get("href"))
+        elif tag == "abbr" and "fn" in classes and not fn_abbrs_done:
+            # The closest <a class="tel"> before the abbr in document order, as find_previous would return
+            is_me = "".join(element.itertext()).strip() == "Me"
+            a_tag = last_tel if is_me else None
+            fn_abbrs.append((is_me, a_tag.get('href') if a_tag is not None else None))
+            fn_abbrs_done = a_tag is not None
+
+        if "participants" in classes:
+            participants.append([
+                lxml_find(participant, "a").attrib["href"][4:] for participant in element.iterchildren(etree.Element)
+            ])
+        if "message" in classes:
+            messages.append(get_message_record_lxml(element))
+        if " ".join(classes) == "contributor vcard":
+            contributors.append(lxml_find(element, "a").attrib["href"][4:])
+        if call_raw is None and "haudio" in classes:
+            call_raw = element
+
+    return {
+        "path": sms_filename,
+        "file": os.path.basename(sms_filename),
+        "srcs": img_srcs + video_srcs + vcard_srcs,
+        "fn_abbrs": fn_abbrs,
+        "participants": participants,
+        "messages": messages,
+        "contributors": contributors,
+        "call": get_call_record_lxml(call_raw) if call_raw is not None else None,
+    }
+
+def get_message_record_lxml(message):
+    sender_data = lxml_find(message, "cite")
+    q = lxml_find(message, "q")
+    return {
+        "type": 2 if lxml_find(sender_data, "span") is None else 1,
+        "has_span": lxml_find(message, "span") is not None,
+        "sender_name": "".join(sender_data.itertext()),
+        "sender": lxml_find(sender_data, "a").attrib["href"][4:],
+        "text": format_message_text(soup_markup(q) if q is not None else "None"),
+        "time": get_time_unix_iso(lxml_find(message, class_name="dt").attrib["title"]),
+        "images": [image.attrib["src"] for image in message.iterdescendants("img")],
+        "videos": [video.get("href") for video in lxml_find_all(message, "a", "video")],
+        "vcards": [vcard.get("href") for vcard in lxml_find_all(message, "a", "vcard")],
+    }
+
+def get_call_record_lxml(call_raw):
+    duration_element = lxml_find(call_raw, class_name="duration")
+    return {
+        "number": lxml_find(call_raw, "a", "tel").get('href').split(':', 1)[-1],
+        "date": get_time_unix_iso(lxml_find(call_raw, class_name="published").attrib["title"]),
+        "duration": duration_element.attrib['title'] if duration_element is not None else "PT0S",
+        "tags": ["".join(tag.itertext()).strip() for tag in call_raw.iterdescendants("a")
+                 if "tag" in tag.get("rel", "").split()],
+    }
+
+# Function to tell whether a tag in the message text repeats an attribute. lxml keeps the first value and
+# BeautifulSoup the last, so parse_conversation_lxml hands such files to parse_conversation. Only message text is
+# checked, as it is copied into the output markup and all; the rest of the file is Google's fixed layout.
+def has_repeated_attribute(markup):
+    return any(b"=" in message_text and REPEATED_ATTRIBUTE_PATTERN.search(message_text)
+               for message_text in MESSAGE_TEXT_PATTERN.findall(markup))
+
+# Functions to find descendants of an lxml element by tag and/or class, like BeautifulSoup's find and find_all
+def lxml_find_all(element, tag=None, class_name=None):
+    for descendant in element.iterdescendants(tag if tag else etree.Element):
+        if class_name is None or class_name in descendant.get("class", "").split():
+            yield descendant
+
+def lxml_find(element, tag=None, class_name=None):
+    return next(lxml_find_all(element, tag, class_name), None)
+
+# Function to serialize an lxml element the way str() serializes a BeautifulSoup tag, so message text is identical
+# with either parser. BeautifulSoup prints attributes sorted by name, and collapses the whitespace in list attributes.
+def soup_markup(element):
+    if not isinstance(element.tag, str):
+        return f"<!--{element.text}-->"
+    markup = ["<", element.tag]
+    list_attributes = SOUP_LIST_ATTRIBUTES['*'] | SOUP_LIST_ATTRIBUTES.get(element.tag, set())
+    for name, value in sorted(element.attrib.items()):
+        if name in list_attributes:
+            value = " ".join(value.split())
+        value = soup_escape(value)
+        if '"' not in value:
+            markup.append(f' {name}="{value}"')
+        elif "'" not in value:
+            markup.append(f" {name}='{value}'")
+        else:
+            markup.append(f' {name}="{value.replace(chr(34), "&quot;")}"')
+    if element.tag in VOID_ELEMENTS:
+        markup.append("/>")
+        return "".join(markup)
+    markup.append(">")
+    markup.append(soup_escape(element.text or ""))
+    for child in element:
+        markup.append(soup_markup(child))
+        markup.append(soup_escape(child.tail or ""))
+    markup.append(f"</{element.tag}>")
+    return "".join(markup)
+
+def soup_escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+# Function to index attachment paths once per run so find_file_path never has to walk the directory tree
+def index_attachment_paths(attachment_paths, base_path, root_path):
+    paths_by_name = {}
+    for att_path in attachment_paths:
+        paths_by_name.setdefault(os.path.basename(att_path), []).append(base_path / att_path)
+    return {
+        # Attachment names in the output are relative to the input folder or archive
+        "root": root_path,
+        "paths_by_name": paths_by_name,
+        # Sorted names answer "starts with" lookups, sorted reversed names answer "ends with" lookups
+        "names": sorted(paths_by_name),
+        "reversed_names": sorted(name[::-1] for name in paths_by_name),
+    }
+
+# Function to find the attachment paths an img, video or vCard src of a conversation file could point to. Returns the
+# filename looked up with the paths. Without supported_types, unmapped srcs match attachments of any type.
+def find_attachment_paths(src, src_filename_map, att_path_index, file, supported_types=None):
+    filename = src_filename_map.get(src)
+    if filename is None or filename == "No unused match found":
+        html_filename_prefix = file.split('-', 1)[0]
+        filename = html_filename_prefix + src[src.find('-'):]
+        # Any attachment named "<filename>.<ext>" with a supported extension
+        return filename, [
+            p
+            for name in find_names_with_prefix(att_path_index["names"], f"{filename}.")
+            if supported_types is None or Path(name).suffix.lower() in supported_types
+            for p in att_path_index["paths_by_name"][name]
+        ]
+    # Any attachment whose name ends with the mapped filename
+    return filename, [
+        p
+        for reversed_name in find_names_with_prefix(att_path_index["reversed_names"], filename[::-1])
+        for p in att_path_index["paths_by_name"][reversed_name[::-1]]
+    ]
+
+# Function to find the names in a sorted list that start with the given prefix
+def find_names_with_prefix(sorted_names, prefix):
+    start = bisect_left(sorted_names, prefix)
+    end = start
+    while end < len(sorted_names) and sorted_names[end].startswith(prefix):
+        end += 1
+    return sorted_names[start:end]
+
+# Function to index, for files titled with a contact name, the first number found in each message thread and the
+# last contributor of each Placed/Received call file, so fallback lookups never rescan or re-parse the Takeout folder
+def index_fallback_numbers(conversations):
+    message_numbers = {}
+    call_numbers = {}
+    for position, conversation in enumerate(conversations):
+        phone_number, participant_number = get_first_phone_number(conversation["messages"], 0)
+        if phone_number != 0:
+            message_numbers.setdefault(conversation["file"], (position, phone_number, participant_number))
+        if conversation["contributors"]:
+            call_numbers.setdefault(conversation["file"], (position, conversation["contributors"][-1]))
+    return {
+        "message_numbers": message_numbers,
+        "message_names": sorted(message_numbers),
+        "call_numbers": call_numbers,
+        "call_names": sorted(call_numbers),
+        "resolved": {},
+    }
+
+# Function to find a fallback number for a conversation from files whose names start with the same contact name.
+# Message threads are tried first, then Placed/Received files, taking the first match in file order.
+def find_fallback_number(fallback_numbers, file):
+    file_prefix = Path(file).stem.split("-")[0]
+    resolved = fallback_numbers["resolved"]
+    if file_prefix not in resolved:
+        message_numbers = fallback_numbers["message_numbers"]
+        call_numbers = fallback_numbers["call_numbers"]
+        message_names = find_names_with_prefix(fallback_numbers["message_names"], file_prefix)
+        call_names = find_names_with_prefix(fallback_numbers["call_names"], f"{file_prefix}- ")
+        if message_names:
+            _, phone_number, participant_number = min(message_numbers[name] for name in message_names)
+            resolved[file_prefix] = (phone_number, participant_number)
+        elif call_names:
+            _, contributor = min(call_numbers[name] for name in call_names)
+            resolved[file_prefix] = get_first_phone_number([], contributor)
+        else:
+            resolved[file_prefix] = (0, "0")
+    return resolved[file_prefix]
+
+# Regexes used for attachment filename matching, compiled once instead of on every call
+NORMALIZE_FILENAME_PATTERN = re.compile(
+    rf"(?:\((\d+)\))?\.({'|'.join(ext.lstrip('.') for ext in ALLOWED_EXTENSIONS)})$"
+)
+FILENAME_SORT_PATTERN = re.compile(r'(.*?)(?:\((\d+)\))?(\.\w+)?$')
 
 # Function to remove file extension and parenthesized numbers from the end of image filenames. This is used to match those filenames back to their respective img_src key.
 def normalize_filename(filename):
     # Remove the file extension and any parenthesized numbers, then truncate at 50 characters
-    extensions_pattern = '|'.join(ext.lstrip('.') for ext in ALLOWED_EXTENSIONS)
-    return re.sub(rf'(?:\((\d+)\))?\.({extensions_pattern})$', '', filename)[:50]
+    return NORMALIZE_FILENAME_PATTERN.sub('', filename)[:50]
 
 # Function to sort filenames so that files with parenthesized numbers appended to the end follow the base filename.
 def custom_filename_sort(filename):
     # This will match the entire filename up to the extension, and capture any numbers in parentheses
-    match = re.match(r'(.*?)(?:\((\d+)\))?(\.\w+)?$', filename)
+    match = FILENAME_SORT_PATTERN.match(filename)
     if match:
         base_filename = match.group(1)
         number = int(match.group(2)) if match.group(2) else -1  # Assign -1 to filenames without parentheses
@@ -251,152 +2137,168 @@ def custom_filename_sort(filename):
         return (filename, float('inf'), '')
 
 # Function to produce a dictionary that maps img src elements (which are unique) to the respective filenames.
+# Each src is assigned the first unused filename, in custom_filename_sort order, whose normalized name appears in the src.
 def src_to_filename_mapping(src_elements, att_filenames):
-    used_filenames = set()
+    # Sort once and group the filenames by normalized name. A filename is only ever used once, so repeats are dropped.
+    filename_index = {}
+    for position, filename in enumerate(sorted(dict.fromkeys(att_filenames), key=custom_filename_sort)):
+        filename_index.setdefault(normalize_filename(filename), deque()).append((position, filename))
+    # Normalized names can match anywhere inside a src, so look up every slice of the src with a length in use
+    key_lengths = Counter(len(key) for key in filename_index)
+
     mapping = {}
     for src in src_elements:
-        att_filenames.sort(key=custom_filename_sort)  # Sort filenames before matching
-        assigned_filename = None
-        for filename in att_filenames:
-            normalized_filename = normalize_filename(filename)
-            if normalized_filename in src and filename not in used_filenames:
-                assigned_filename = filename
-                used_filenames.add(filename)
-                break
-        mapping[src] = assigned_filename or 'No unused match found'
+        assigned_key = None
+        for length in key_lengths:
+            for start in range(len(src) - length + 1):
+                key = src[start:start + length]
+                candidates = filename_index.get(key)
+                if candidates and (assigned_key is None or candidates[0] < filename_index[assigned_key][0]):
+                    assigned_key = key
+        if assigned_key is None:
+            mapping[src] = 'No unused match found'
+            continue
+        candidates = filename_index[assigned_key]
+        mapping[src] = candidates.popleft()[1] or 'No unused match found'
+        if not candidates:
+            del filename_index[assigned_key]
+            key_lengths[len(assigned_key)] -= 1
+            if not key_lengths[len(assigned_key)]:
+                del key_lengths[len(assigned_key)]
     return mapping
 
-def write_sms_messages(file, messages_raw, own_number, src_filename_map):
+# Records made by iter_records. Numbers are in E.164 where they parse, dates are in milliseconds since the epoch and
+# message text is escaped the way it is written to the XML, get_text() gives it back plain. Large Takeouts make
+# millions of them, hence __slots__.
+class Sms:
+    __slots__ = ("address", "date", "type", "body")
+
+    def __init__(self, address, date, message_type, body):
+        self.address = address
+        self.date = date
+        self.type = message_type  # 1 received, 2 sent
+        self.body = body
+
+    def get_text(self):
+        return html.unescape(self.body)
+
+class Mms:
+    __slots__ = ("address", "date", "m_type", "msg_box", "text_only", "text", "attachments", "addrs", "tr_id")
+
+    def __init__(self, address, date, m_type, msg_box, text_only, text, attachments, addrs, tr_id):
+        self.address = address  # Participants joined with ~
+        self.date = date
+        self.m_type = m_type
+        self.msg_box = msg_box  # 1 received, 2 sent
+        self.text_only = text_only
+        self.text = text
+        self.attachments = attachments
+        self.addrs = addrs  # (number, 137 for the sender or 151 for a recipient) for each participant
+        self.tr_id = tr_id
+
+    def get_text(self):
+        return html.unescape(self.text)
+
+# Handle to an MMS attachment in the Takeout folder or archive, which is only read when opened
+class Attachment:
+    __slots__ = ("content_type", "path", "root_path")
+
+    def __init__(self, content_type, path, root_path):
+        self.content_type = content_type
+        self.path = path
+        self.root_path = root_path
+
+    # Name of the attachment in the output, relative to the Takeout folder
+    @property
+    def name(self):
+        return str(self.path.relative_to(self.root_path))
+
+    def get_size(self):
+        return get_takeout_file_size(self.path)
+
+    def open(self):
+        return open_takeout_file(self.path)
+
+class Call:
+    __slots__ = ("number", "date", "duration", "type")
+
+    def __init__(self, number, date, duration, call_type):
+        self.number = number
+        self.date = date
+        self.duration = duration  # Seconds
+        self.type = call_type  # Values of CALL_TAG_TO_TYPE
+
+def iter_sms_records(file, messages, own_number, src_filename_map, att_path_index, fallback_numbers):
     fallback_number = 0
     title_has_number = re.search(r"(^\+[0-9]+)", Path(file).name)
     if title_has_number:
         fallback_number = title_has_number.group()
 
-    phone_number, participant_raw = get_first_phone_number(
-        messages_raw, fallback_number
+    phone_number, participant_number = get_first_phone_number(
+        messages, fallback_number
     )
 
-    # Search similarly named files for a fallback number. This is desperate and expensive, but hopefully rare.
-    if phone_number == 0:
-        file_prefix = "-".join(Path(file).stem.split("-")[0:1])
-        for fallback_file in Path.cwd().glob(f"**/{file_prefix}*.html"):
-            with fallback_file.open("r", encoding="utf8") as ff:
-                soup = BeautifulSoup(ff, "html.parser")
-            messages_raw_ff = soup.find_all(class_="message")
-            phone_number, participant_raw = get_first_phone_number(messages_raw_ff, 0)
-            if phone_number != 0:
-                break
-
-    # Start looking in the Placed/Received files for a fallback number
+    # Look up similarly named files for a fallback number
     if phone_number == 0:
-        file_prefix = f'{Path(file).stem.split("-")[0]}- '
-        for fallback_file in Path.cwd().glob(f"**/{file_prefix}*.html"):
-            with fallback_file.open("r", encoding="utf8") as ff:
-                soup = BeautifulSoup(ff, "html.parser")
-            contrib_vcards = soup.find_all(class_="contributor vcard")
-            phone_number_ff = 0
-            for contrib_vcard in contrib_vcards:
-                phone_number_ff = contrib_vcard.a["href"][4:]
-            phone_number, participant_raw = get_first_phone_number([], phone_number_ff)
-            if phone_number != 0:
-                break
-
-    sms_values = {"phone": phone_number}
-
-    sms_backup_file = open(sms_log_filename, "a", encoding="utf8")
+        phone_number, participant_number = find_fallback_number(fallback_numbers, file)
 
-    for message in messages_raw:
+    for message in messages:
         # Check if message has an image, video or vCard in it and treat as MMS if so
-        if message.find_all("img") or message.find_all("a", class_='vcard') or message.find_all("a", class_='video'):
-            write_mms_messages(file, [[participant_raw]], [message], own_number, src_filename_map)
+        if message["images"] or message["vcards"] or message["videos"]:
+            yield from iter_mms_records(file, [[participant_number]], [message], own_number, src_filename_map,
+                                        att_path_index)
             continue
-        if message.find_all("a", class_='video'):
-            write_mms_messages(file, [[participant_raw]], [message], own_number, src_filename_map)
-            continue
-        message_content = get_message_text(message)
+        message_content = message["text"]
         if message_content == "MMS Sent" or message_content == "MMS Received":
             continue
-        sms_values["type"] = get_message_type(message)
-        sms_values["message"] = message_content
-        sms_values["time"] = get_time_unix(message)
-        sms_text = (
-            '<sms protocol="0" address="%(phone)s" '
-            'date="%(time)s" type="%(type)s" '
-            'subject="null" body="%(message)s" '
-            'toa="null" sc_toa="null" service_center="null" '
-            'read="1" status="1" locked="0" /> \n' % sms_values
-        )
-        sms_backup_file.write(sms_text)
-
-    sms_backup_file.close()
-
-def write_mms_messages(file, participants_raw, messages_raw, own_number, src_filename_map):
-    sms_backup_file = open(sms_log_filename, "a", encoding="utf8")
+        yield Sms(phone_number, message["time"], message["type"], message_content)
 
+def iter_mms_records(file, participants_raw, messages, own_number, src_filename_map, att_path_index):
     participants = get_participant_phone_numbers(participants_raw)
     participants_text = "~".join(participants)
 
     # Adding own_number to participants if it exists and is not already in the list
     def find_file_path(src, src_filename_map, file, supported_types):
-        filename = src_filename_map.get(src)
-        if filename is None or filename == "No unused match found":
-            html_filename_prefix = file.split('-', 1)[0]
-            filename = html_filename_prefix + src[src.find('-'):]
-            filename_with_ext = f"{filename}.*"
-            file_path = list(Path.cwd().glob(f"**/{filename_with_ext}"))
-            file_path = [p for p in file_path if p.suffix[1:] in supported_types]
-        else:
-            file_path = [p for p in Path.cwd().glob(f"**/*{filename}") if p.is_file()]
+        start = perf_counter()
+        filename, file_path = find_attachment_paths(src, src_filename_map, att_path_index, file, supported_types)
 
         assert len(file_path) != 0, f"No matching files found. File name: {filename}"
         assert len(file_path) == 1, f"Multiple potential matching files found. Files: {[x for x in file_path]!r}"
 
+        add_metric("find_file_path", start)
         return file_path[0]
 
-    for message in messages_raw:
+    for message in messages:
         # Sometimes the sender tel field is blank. Try to guess the sender from the participants.
         sender = get_mms_sender(message, participants)
         sent_by_me = sender == own_number
         if own_number not in participants:
             participants.append(own_number)
 
-        # Handle images and vcards
-        images = message.find_all("img")
-        image_parts = ""
-        videos = message.find_all("a", class_='video')
-        video_parts = ""
-        vcards = message.find_all("a", class_='vcard')
-        vcard_parts = ""
+        # Handle images and vcards. Parts are collected as (content type, path), their data is only read when written.
+        images = message["images"]
+        image_parts = []
+        videos = message["videos"]
+        video_parts = []
+        vcards = message["vcards"]
+        vcard_parts = []
         extracted_url = ""
         if images:
             text_only = 0
-            for image in images:
+            for image_src in images:
                 supported_types = IMAGE_EXTENSIONS
-                image_src = image["src"]
                 image_path = find_file_path(image_src, src_filename_map, file, supported_types)
                 image_type = image_path.suffix[1:]
                 image_type = "jpeg" if image_type == "jpg" else image_type
 
-                with image_path.open("rb") as fb:
-                    image_bytes = fb.read()
-                byte_string = f"{b64encode(image_bytes)}"
-
-                relative_image_path = image_path.relative_to(Path.cwd())
-
-                image_parts += (
-                    f'    <part seq="0" ct="image/{image_type}" name="{relative_image_path}" '
-                    f'chset="null" cd="null" fn="null" cid="&lt;{relative_image_path}&gt;" '
-                    f'cl="{relative_image_path}" ctt_s="null" ctt_t="null" text="null" '
-                    f'data="{byte_string[2:-1]}" />\n'
-                )
+                image_parts.append((f"image/{image_type}", image_path))
         if vcards:
             text_only = 0
-            for vcard in vcards:
+            for vcard_src in vcards:
                 supported_types = VCARD_EXTENSION
-                vcard_src = vcard.get("href")
                 vcard_path = find_file_path(vcard_src, src_filename_map, file, supported_types)
 
-                with vcard_path.open("r", encoding="utf-8") as fb:
+                with TextIOWrapper(open_takeout_file(vcard_path), encoding="utf-8") as fb:
                     current_location_found = False
                     for line in fb:
                         if line.startswith("FN:") and "Current Location" in line:
@@ -408,110 +2310,379 @@ def write_mms_messages(file, participants_raw, messages_raw, own_number, src_fil
                             break
 
                     if not current_location_found:
-                        with vcard_path.open("rb") as fb:
-                            vcard_bytes = fb.read()
-                            byte_string = f"{b64encode(vcard_bytes)}"
-
-                            # Use the full path and then derive the relative path, ensuring the complete filename is used
-                            relative_vcard_path = vcard_path.relative_to(Path.cwd())
-    
-                            vcard_parts += (
-                                f'    <part seq="0" ct="text/x-vCard" name="{relative_vcard_path}" '
-                                f'chset="null" cd="null" fn="null" cid="&lt;{relative_vcard_path}&gt;" '
-                                f'cl="{relative_vcard_path}" ctt_s="null" ctt_t="null" text="null" '
-                                f'data="{byte_string[2:-1]}" />\n'
-                            )
+                        vcard_parts.append(("text/x-vCard", vcard_path))
         if videos:
                     text_only = 0
-                    for video in videos:
+                    for video_src in videos:
                         supported_types = VIDEO_EXTENSIONS
-                        video_src = video.get("href")
                         video_path = find_file_path(video_src, src_filename_map, file, supported_types)
                         video_type = video_path.suffix[1:]
                         video_type = "3gpp" if video_type == "3gp" else video_type
 
-                        with video_path.open("rb") as fb:
-                            video_bytes = fb.read()
-                        byte_string = f"{b64encode(video_bytes)}"
-
-                        relative_video_path = video_path.relative_to(Path.cwd())
-
-                        video_parts += (
-                            f'    <part seq="0" ct="video/{video_type}" name="{relative_video_path}" '
-                            f'chset="null" cd="null" fn="null" cid="&lt;{relative_video_path}&gt;" '
-                            f'cl="{relative_video_path}" ctt_s="null" ctt_t="null" text="null" '
-                            f'data="{byte_string[2:-1]}" />\n'
-                        )
+                        video_parts.append((f"video/{video_type}", video_path))
 
         else:
             text_only = 1
         if extracted_url:
             message_text = "Dropped pin&#10;" + extracted_url
         else:
-            message_text = get_message_text(message)
+            message_text = message["text"]
         #message_text = get_message_text(message)
-        time = get_time_unix(message)
-        participants_xml = ""
+        time = message["time"]
         msg_box = 2 if sent_by_me else 1
         m_type = 128 if sent_by_me else 132
+
+        parts = image_parts + video_parts + vcard_parts
+
+        addrs = []
         for participant in participants:
             participant_is_sender = participant == sender or (
                 sent_by_me and participant == "Me"
             )
-            participant_values = {
-                "number": participant,
-                "code": 137 if participant_is_sender else 151,
-            }
-            participants_xml += (
-                '    <addr address="%(number)s" charset="106" type="%(code)s"/> \n'
-                % participant_values
-            )
-
-            mms_text = (
-                f'<mms address="{participants_text}" ct_t="application/vnd.wap.multipart.related" '
-                f'date="{time}" m_type="{m_type}" msg_box="{msg_box}" read="1" '
-                f'rr="129" seen="1" sim_slot="1" sub_id="-1" text_only="{text_only}"> \n'
-                "  <parts> \n"
-            )
-
-            # This skips the plain text part in an MMS message if it contains the phrases "MMS Sent" or "MMS Received".
-            if message_text not in ["MMS Sent", "MMS Received"]:
-                mms_text += f'    <part ct="text/plain" seq="0" text="{message_text}"/> \n'
-
-            mms_text += image_parts
-            mms_text += video_parts
-            mms_text += vcard_parts
+            addrs.append((participant, 137 if participant_is_sender else 151))
 
-            mms_text += (
-                "  </parts> \n"
-                "  <addrs> \n"
-                f"{participants_xml}"
-                "  </addrs> \n"
-                "</mms> \n"
-                )
-
-        sms_backup_file.write(mms_text)
-
-    sms_backup_file.close()
+        yield Mms(participants_text, time, m_type, msg_box, text_only, message_text,
+                  [Attachment(content_type, att_path, att_path_index["root"]) for content_type, att_path in parts],
+                  addrs, get_mms_transaction_id(participants_text, time, msg_box, message_text, parts))
 
+# Function to write an SMS record to the SMS Backup & Restore XML
+def write_sms(sms, sms_backup_file):
+    sms_backup_file.write(
+        f'<sms protocol="0" address="{sms.address}" date="{sms.date}" type="{sms.type}" subject="null" '
+        f'body="{sms.body}" toa="null" sc_toa="null" service_center="null" read="1" status="1" locked="0" /> \n'
+    )
 
-def write_call(call_raw, call_log_filename):
-    number = call_raw.find('a', class_='tel').get('href').split(':', 1)[-1]
-    date = get_time_unix_call(call_raw)
-    duration_element = call_raw.find(class_='duration')
-    duration_raw = duration_element['title'] if duration_element else "PT0S"
-    duration = round(isodate.parse_duration(duration_raw).total_seconds())
-    call_type = get_call_type(call_raw)
-    if call_type is None:
+# Function to write an MMS record, its attachments streamed in from the Takeout or the attachment cache
+def write_mms(mms, attachment_cache, sms_backup_file):
+    mms_chunks = [
+        f'<mms address="{mms.address}" ct_t="application/vnd.wap.multipart.related" '
+        f'date="{mms.date}" m_type="{mms.m_type}" msg_box="{mms.msg_box}" read="1" '
+        f'rr="129" seen="1" sim_slot="1" sub_id="-1" text_only="{mms.text_only}" '
+        f'tr_id="{mms.tr_id}"> \n',
+        "  <parts> \n",
+    ]
+    # This skips the plain text part in an MMS message if it contains the phrases "MMS Sent" or "MMS Received".
+    if mms.text not in ["MMS Sent", "MMS Received"]:
+        mms_chunks.append(f'    <part ct="text/plain" seq="0" text="{mms.text}"/> \n')
+    sms_backup_file.writelines(mms_chunks)
+
+    for attachment in mms.attachments:
+        write_attachment_part(sms_backup_file, attachment, attachment_cache)
+
+    sms_backup_file.writelines([
+        "  </parts> \n", "  <addrs> \n",
+        *(f'    <addr address="{number}" charset="106" type="{code}"/> \n' for number, code in mms.addrs),
+        "  </addrs> \n", "</mms> \n",
+    ])
+
+
+# Function to derive the transaction ID of an MMS from what identifies the message, so the same message converted from
+# different Takeouts gets the same tr_id, which SMS Backup & Restore uses to skip duplicates
+def get_mms_transaction_id(participants_text, time, msg_box, message_text, parts):
+    identity = "\0".join([participants_text, str(time), str(msg_box), message_text,
+                          *(content_type for content_type, _ in parts)])
+    return "T" + hashlib.blake2b(identity.encode("utf8"), digest_size=8).hexdigest()
+
+# Attachments are base64-encoded this many bytes at a time, so large videos are never held in memory whole.
+# A multiple of 3 encodes without padding, so the encoded chunks can simply be written one after another.
+ATTACHMENT_CHUNK_SIZE = 3 * 256 * 1024
+
+# Conversations, or messages when writing from a store, whose attachments are queued for prefetching ahead of the one
+# being written
+PREFETCH_LOOKAHEAD = 16
+
+# Function to write an attachment <part>, taking its base64 data from the attachment cache or streaming it straight
+# into the output file
+def write_attachment_part(sms_backup_file, attachment, attachment_cache):
+    # Use the full path and then derive the relative path, ensuring the complete filename is used
+    att_path = attachment.path
+    relative_path = attachment.name
+    sms_backup_file.write(
+        f'    <part seq="0" ct="{attachment.content_type}" name="{relative_path}" '
+        f'chset="null" cd="null" fn="null" cid="&lt;{relative_path}&gt;" '
+        f'cl="{relative_path}" ctt_s="null" ctt_t="null" text="null" '
+        'data="'
+    )
+    prefetcher = attachment_cache["prefetcher"]
+    chunks = prefetcher.take(att_path) if prefetcher else None
+    key = get_attachment_cache_key(att_path, attachment_cache, chunks)
+    if not write_cached_attachment(sms_backup_file, att_path, key, attachment_cache):
+        encode_attachment(sms_backup_file, att_path, key, attachment_cache, chunks)
+    sms_backup_file.write('" />\n')
+
+# Function to base64-encode an attachment into the output file a chunk at a time, adding it to the cache as it goes.
+# chunks are the attachment's content when the prefetcher already read it.
+def encode_attachment(sms_backup_file, att_path, key, attachment_cache, chunks=None):
+    start = perf_counter()
+    att_size = get_takeout_file_size(att_path)
+    # Only attachments sharing their size with another one can be duplicates, so only those are keyed by content
+    content_hash = None
+    if key is None:
+        if att_size in attachment_cache["shared_sizes"]:
+            content_hash = hashlib.blake2b(digest_size=16)
+        else:
+            key = str(att_path)
+    # Payloads of attachments that can repeat are kept in memory when they fit the budget, spilled to disk when there
+    # is a spill directory, and otherwise just written out. Other attachments are only ever written out.
+    can_repeat = att_size in attachment_cache["shared_sizes"] or att_path in attachment_cache["repeated_paths"]
+    encoded_size = (att_size + 2) // 3 * 4
+    encoded_chunks = [] if can_repeat and encoded_size <= attachment_cache["memory_budget"] else None
+    spill_file = None
+    if can_repeat and encoded_chunks is None and attachment_cache["spill_dir"]:
+        spill_file = NamedTemporaryFile("w", encoding="ascii", dir=attachment_cache["spill_dir"], delete=False)
+
+    remainder = b""
+    for chunk in iter_attachment_chunks(att_path, chunks):
+        if content_hash:
+            content_hash.update(chunk)
+        if remainder:
+            chunk = remainder + chunk
+        # Keep any short read's leftover bytes for the next chunk so padding only ever appears at the end
+        aligned_length = len(chunk) - len(chunk) % 3
+        encoded_chunk = b64encode(memoryview(chunk)[:aligned_length]).decode("ascii")
+        sms_backup_file.write(encoded_chunk)
+        if encoded_chunks is not None:
+            encoded_chunks.append(encoded_chunk)
+        if spill_file:
+            spill_file.write(encoded_chunk)
+        remainder = chunk[aligned_length:]
+    encoded_chunk = b64encode(remainder).decode("ascii")
+    sms_backup_file.write(encoded_chunk)
+
+    attachment_cache["misses"] += 1
+    if can_repeat:
+        if content_hash:
+            key = content_hash.hexdigest()
+        attachment_cache["keys_by_path"][att_path] = key
+        attachment_cache["encoded_sizes"].add(att_size)
+    if encoded_chunks is not None:
+        encoded_chunks.append(encoded_chunk)
+        add_to_attachment_cache(attachment_cache, key, "".join(encoded_chunks))
+    elif spill_file:
+        spill_file.write(encoded_chunk)
+        spill_file.close()
+        attachment_cache["spilled"][key] = spill_file.name
+    add_metric("attachment_encode", start)
+
+# Function to create the cache of base64-encoded attachment payloads, so repeated attachments are only encoded once.
+# Payloads are keyed by path, or by content hash when a same-sized attachment could be a copy under another name.
+# Only attachments that can repeat are kept: those sharing their size with another one, and repeated_paths, the
+# ones more than one message points to.
+def new_attachment_cache(memory_budget, spill_dir, shared_sizes, repeated_paths, prefetch_threads=0,
+                         prefetch_budget=0):
+    return {
+        "prefetcher": AttachmentPrefetcher(prefetch_threads, prefetch_budget) if prefetch_threads else None,
+        "memory_budget": memory_budget,
+        "memory_used": 0,
+        "entries": OrderedDict(),  # key -> encoded payload, least recently used first
+        "spill_dir": spill_dir,
+        "spilled": {},  # key -> file holding an encoded payload that did not fit in memory
+        "keys_by_path": {},
+        "shared_sizes": shared_sizes,
+        "repeated_paths": repeated_paths,
+        "encoded_sizes": set(),
+        "hits": 0,
+        "misses": 0,
+        "bytes_saved": 0,
+    }
+
+# Function to find the attachment sizes that occur more than once, the only ones whose attachments could be copies.
+# The set is worked out once and handed to every process.
+def get_shared_sizes(attachment_sizes):
+    size_counts = Counter(attachment_sizes)
+    return {size for size, count in size_counts.items() if count > 1}
+
+# Function to find the attachment paths more than one src points to, counting every path an unmapped src could
+# match. Like the shared sizes, the set is worked out once and handed to every process.
+def get_repeated_paths(conversations, src_filename_map, att_path_index):
+    if att_path_index is None:
+        return set()
+    path_counts = Counter(
+        path
+        for conversation in conversations
+        for src in conversation["srcs"]
+        for path in find_attachment_paths(src, src_filename_map, att_path_index, conversation["file"])[1]
+    )
+    return {path for path, count in path_counts.items() if count > 1}
+
+def add_to_attachment_cache(attachment_cache, key, payload):
+    entries = attachment_cache["entries"]
+    entries[key] = payload
+    attachment_cache["memory_used"] += len(payload)
+    # Evict least recently used payloads, to disk if there is a spill directory
+    while attachment_cache["memory_used"] > attachment_cache["memory_budget"]:
+        evicted_key, evicted_payload = entries.popitem(last=False)
+        attachment_cache["memory_used"] -= len(evicted_payload)
+        if attachment_cache["spill_dir"]:
+            with NamedTemporaryFile("w", encoding="ascii", dir=attachment_cache["spill_dir"], delete=False) as spill_file:
+                spill_file.write(evicted_payload)
+            attachment_cache["spilled"][evicted_key] = spill_file.name
+
+# Function to find an attachment's cache key without reading it, unless a same-sized attachment was already encoded
+# and this one may be a copy of it. Returns None when the key is only known after encoding.
+def get_attachment_cache_key(att_path, attachment_cache, chunks=None):
+    key = attachment_cache["keys_by_path"].get(att_path)
+    if key is None and get_takeout_file_size(att_path) in attachment_cache["encoded_sizes"]:
+        key = hash_attachment(att_path, chunks)
+    return key
+
+# Function to write an attachment's encoded payload from the cache. Returns False if it is not cached.
+def write_cached_attachment(sms_backup_file, att_path, key, attachment_cache):
+    entries = attachment_cache["entries"]
+    if key in entries:
+        entries.move_to_end(key)
+        payload = entries[key]
+        sms_backup_file.write(payload)
+        payload_size = len(payload)
+    elif key in attachment_cache["spilled"]:
+        payload_size = 0
+        with open(attachment_cache["spilled"][key], "r", encoding="ascii") as spill_file:
+            while payload := spill_file.read(ATTACHMENT_CHUNK_SIZE):
+                sms_backup_file.write(payload)
+                payload_size += len(payload)
+    else:
+        return False
+    attachment_cache["keys_by_path"][att_path] = key
+    attachment_cache["hits"] += 1
+    attachment_cache["bytes_saved"] += payload_size
+    return True
+
+def hash_attachment(att_path, chunks=None):
+    content_hash = hashlib.blake2b(digest_size=16)
+    for chunk in iter_attachment_chunks(att_path, chunks):
+        content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+# Function to read an attachment a chunk at a time, or to go over the chunks the prefetcher already read
+def iter_attachment_chunks(att_path, chunks=None):
+    if chunks is not None:
+        yield from chunks
+        return
+    with open_takeout_file(att_path) as fb:
+        while chunk := fb.read(ATTACHMENT_CHUNK_SIZE):
+            yield chunk
+
+def get_attachment_cache_stats(attachment_cache):
+    return attachment_cache["hits"], attachment_cache["misses"], attachment_cache["bytes_saved"]
+
+def close_attachment_cache(attachment_cache):
+    if attachment_cache["prefetcher"]:
+        attachment_cache["prefetcher"].close()
+
+# Reads attachments in background threads before they are written, so the conversion doesn't stop on each file read.
+# Attachments are read in the same chunks they are encoded in, and only as many as fit in the byte budget are held at
+# a time. Larger ones are left to be read when written, as without prefetching.
+class AttachmentPrefetcher:
+    def __init__(self, threads, budget):
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="prefetch")
+        self.budget = budget
+        self.bytes_held = 0
+        self.pending = OrderedDict()  # path -> size, waiting for room in the budget
+        self.reads = {}  # path -> (future, size), read or being read
+
+    def add(self, att_path):
+        if att_path in self.reads or att_path in self.pending:
+            return
+        size = get_takeout_file_size(att_path)
+        if size <= self.budget:
+            self.pending[att_path] = size
+            self.start_reads()
+
+    def start_reads(self):
+        while self.pending:
+            att_path, size = next(iter(self.pending.items()))
+            if self.bytes_held + size > self.budget:
+                break
+            del self.pending[att_path]
+            self.reads[att_path] = (self.executor.submit(read_attachment, att_path), size)
+            self.bytes_held += size
+
+    # Function to get an attachment's chunks, waiting if it is still being read. Returns None if it wasn't read
+    # ahead, and the caller reads it itself.
+    def take(self, att_path):
+        self.pending.pop(att_path, None)
+        if att_path not in self.reads:
+            return None
+        future, size = self.reads.pop(att_path)
+        start = perf_counter()
+        chunks, read_seconds = future.result()
+        add_metric("prefetch_wait", start)
+        run_metrics["seconds"]["prefetch_read"] += read_seconds
+        run_metrics["calls"]["prefetch_read"] += 1
+        self.bytes_held -= size
+        self.start_reads()
+        return chunks
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+# Function run in prefetch threads, returning an attachment's chunks and the time it took to read them
+def read_attachment(att_path):
+    start = perf_counter()
+    chunks = list(iter_attachment_chunks(att_path))
+    return chunks, perf_counter() - start
+
+# Function to queue the attachments of records with the prefetcher, except those already encoded, which are likely to
+# come from the attachment cache
+def prefetch_attachments(attachment_cache, records):
+    prefetcher = attachment_cache["prefetcher"]
+    if not prefetcher:
+        return
+    for record in records:
+        if isinstance(record, Mms):
+            for attachment in record.attachments:
+                if attachment.path not in attachment_cache["keys_by_path"]:
+                    prefetcher.add(attachment.path)
+
+# Function to pass on lists of records PREFETCH_LOOKAHEAD lists after queueing their attachments with the prefetcher
+def prefetch_ahead(record_lists, attachment_cache):
+    lookahead = deque()
+    record_lists = iter(record_lists)
+    while True:
+        try:
+            records = next(record_lists, None)
+            if records is None:
+                break
+            prefetch_attachments(attachment_cache, records)
+        except Exception as error:
+            # A conversation that can't be converted raises when its turn comes, after the ones before it are
+            # written, so the error follows its own "Processing" line
+            lookahead.append(error)
+            break
+        lookahead.append(records)
+        if len(lookahead) > PREFETCH_LOOKAHEAD:
+            yield lookahead.popleft()
+    for records in lookahead:
+        if isinstance(records, Exception):
+            raise records
+        yield records
+
+# Function to choose the number of prefetch threads. Members of a tar archive are read through one shared file
+# position, so they are never read from several threads.
+def get_prefetch_threads(prefetch_threads, archive_path):
+    if prefetch_threads and archive_path and not is_zipfile(archive_path):
+        print("Attachments are not prefetched from tar archives")
         return 0
+    return prefetch_threads
+
+# Function to make the Call record of a parsed call, or None when it has no number or type
+def new_call(call):
+    number = call["number"]
+    date = call["date"]
+    duration = round(isodate.parse_duration(call["duration"]).total_seconds())
+    call_type = get_call_type(call["tags"])
+    if call_type is None:
+        return None
     if not number:
-        return 0
-    with open(call_log_filename, "a", encoding="utf8") as call_log_file:
-        call_text = (
-            f'<call number="{number}" date="{date}" duration="{duration}" type="{call_type}" presentation="1" /> \n'
-        )
-        call_log_file.write(call_text)
-    return 1
+        return None
+    return Call(number, date, duration, call_type)
+
+def write_call(call, call_log_file):
+    call_text = (
+        f'<call number="{call.number}" date="{call.date}" duration="{call.duration}" type="{call.type}" '
+        'presentation="1" /> \n'
+    )
+    call_log_file.write(call_text)
 
 def get_message_type(message):  # author_raw = messages_raw[i].cite
     author_raw = message.cite
@@ -522,15 +2693,13 @@ def get_message_type(message):  # author_raw = messages_raw[i].cite
 
     return 0
 
-def get_call_type(call_raw):
-    tag_elements = call_raw.find_all('a', rel='tag')
-    for tag in tag_elements:
-        tag_text = tag.get_text(strip=True)
+def get_call_type(tags):
+    for tag_text in tags:
         if tag_text in CALL_TAG_TO_TYPE:
             return CALL_TAG_TO_TYPE[tag_text]
         
     
-    print("Tags found: ", [tag.get_text(strip=True) for tag in tag_elements])
+    print("Tags found: ", tags)
 
     assert False, "Could not determine call type"
 
@@ -538,14 +2707,17 @@ def get_message_text(message):
     # Attempt to properly translate newlines. Might want to translate other HTML here, too.
     # This feels very hacky, but couldn't come up with something better.
     # Added additional replace() calls to strip out special character that were causing issues with importing the XML file.
-    message_text = str(message.find("q")).strip()[3:-4].replace("<br/>", "&#10;").replace("'", "&apos;").replace('"', "&quot;").replace("<", "&lt;").replace(">", "&gt;")
+    return format_message_text(str(message.find("q")))
+
+def format_message_text(q_markup):
+    message_text = q_markup.strip()[3:-4].replace("<br/>", "&#10;").replace("'", "&apos;").replace('"', "&quot;").replace("<", "&lt;").replace(">", "&gt;")
 
     return message_text
 
 def get_mms_sender(message, participants):
-    number_text = message.cite.a["href"][4:]
+    number_text = message["sender"]
     if number_text != "":
-        number = format_number(phonenumbers.parse(number_text, None))
+        number = format_number_text(number_text)
     else:
         assert (
             len(participants) == 1
@@ -555,56 +2727,41 @@ def get_mms_sender(message, participants):
 
 def get_first_phone_number(messages, fallback_number):
     # handle group messages
-    for author_raw in messages:
-        if not author_raw.span:
+    for message in messages:
+        if not message["has_span"]:
             continue
 
-        sender_data = author_raw.cite
         # Skip if first number is Me
-        if sender_data.text == "Me":
+        if message["sender_name"] == "Me":
             continue
-        phonenumber_text = sender_data.a["href"][4:]
+        phonenumber_text = message["sender"]
         # Sometimes the first entry is missing a phone number
         if phonenumber_text == "":
             continue
 
-        try:
-            phone_number = phonenumbers.parse(phonenumber_text, None)
-        except phonenumbers.phonenumberutil.NumberParseException:
-            return phonenumber_text, sender_data
+        phone_number = normalize_number(phonenumber_text)
+        if phone_number is None:
+            return phonenumber_text, phonenumber_text
 
-        # sender_data can be used as participant for mms
-        return format_number(phone_number), sender_data
+        # the sender's number can be used as participant for mms
+        return phone_number, phonenumber_text
 
     # fallback case, use number from filename
     if fallback_number != 0 and len(fallback_number) >= 7:
-        fallback_number = format_number(phonenumbers.parse(fallback_number, None))
-    # Create dummy participant
-    sender_data = BeautifulSoup(
-        f'<cite class="sender vcard"><a class="tel" href="tel:{fallback_number}"><abbr class="fn" '
-        'title="">Foo</abbr></a></cite>',
-        features="html.parser",
-    )
-    return fallback_number, sender_data
+        fallback_number = format_number_text(fallback_number)
+    # Use the fallback number as a dummy participant
+    return fallback_number, f"{fallback_number}"
 
 def get_participant_phone_numbers(participants_raw):
     participants = []
 
     for participant_set in participants_raw:
-        for participant in participant_set:
-            if not hasattr(participant, "a"):
-                continue
-
-            phone_number_text = participant.a["href"][4:]
+        for phone_number_text in participant_set:
             assert (
                 phone_number_text != "" and phone_number_text != "0"
             ), "Could not find participant phone number. Usually caused by empty tel field."
-            try:
-                participants.append(
-                    format_number(phonenumbers.parse(phone_number_text, None))
-                )
-            except phonenumbers.phonenumberutil.NumberParseException:
-                participants.append(phone_number_text)
+            phone_number = normalize_number(phone_number_text)
+            participants.append(phone_number if phone_number is not None else phone_number_text)
 
     return participants
 
@@ -612,43 +2769,143 @@ def get_participant_phone_numbers(participants_raw):
 def format_number(phone_number):
     return phonenumbers.format_number(phone_number, phonenumbers.PhoneNumberFormat.E164)
 
+# Function to parse and format a raw number in E.164. The same few numbers come up on every message, so results
+# are memoized, including None for numbers phonenumbers can't parse.
+@lru_cache(maxsize=NUMBER_CACHE_SIZE)
+def normalize_number(number_text):
+    try:
+        return format_number(phonenumbers.parse(number_text, None))
+    except phonenumbers.phonenumberutil.NumberParseException:
+        return None
+
+# Same as normalize_number, but numbers that can't be parsed are an error
+def format_number_text(number_text):
+    phone_number = normalize_number(number_text)
+    if phone_number is None:
+        phonenumbers.parse(number_text, None)  # Raises the NumberParseException
+    return phone_number
+
 
 def get_time_unix(message):
     time_raw = message.find(class_="dt")
-    ymdhms = time_raw["title"]
-    time_obj = dateutil.parser.isoparse(ymdhms)
-    # Changed this line to get the full date value including milliseconds.
-    mstime = time.mktime(time_obj.timetuple()) * 1000 + time_obj.microsecond // 1000
-    return int(mstime)
+    return get_time_unix_iso(time_raw["title"])
     
 def get_time_unix_call(call_raw):
     time_raw = call_raw.find(class_="published")
-    ymdhms = time_raw["title"]
+    return get_time_unix_iso(time_raw["title"])
+
+def get_time_unix_iso(ymdhms):
+    # Fast path for the fixed Takeout format. Like timetuple() on the parsed datetime, the wall clock time goes to
+    # mktime unchanged, and the UTC offset only decides the DST flag (0 with an offset, -1 without).
+    match = ISO_TIMESTAMP_PATTERN.fullmatch(ymdhms)
+    if match and match[4] != "24":
+        year, month, day, hour, minute, second, fraction, utc_offset = match.groups()
+        time_tuple = (int(year), int(month), int(day), int(hour), int(minute), int(second), 0, 0,
+                      0 if utc_offset else -1)
+        mstime = time.mktime(time_tuple) * 1000 + int(fraction[:3].ljust(3, "0") if fraction else 0)
+        return int(mstime)
+
     time_obj = dateutil.parser.isoparse(ymdhms)
     # Changed this line to get the full date value including milliseconds.
     mstime = time.mktime(time_obj.timetuple()) * 1000 + time_obj.microsecond // 1000
     return int(mstime)
 
-def write_sms_header(filename, numsms):
-    # Prepend header in memory efficient manner since the output file can be huge
-    with NamedTemporaryFile(dir=Path.cwd(), delete=False) as backup_temp:
-        backup_temp.write(b"<?xml version='1.0' encoding='UTF-8' standalone='yes' ?>\n")
-        backup_temp.write(b"\n")
-        backup_temp.write(bytes(f'<smses count="{str(numsms)}">\n', encoding="utf8"))
-        with open(filename, "rb") as backup_file:
-            copyfileobj(backup_file, backup_temp)
-    # Overwrite output file with temp file
-    move(backup_temp.name, filename)
-
-def write_calls_header(filename, numcalls):
-    # Prepend header in memory efficient manner since the output file can be huge
-    with NamedTemporaryFile(dir=Path.cwd(), delete=False) as backup_temp:
-        backup_temp.write(b"<?xml version='1.0' encoding='UTF-8' standalone='yes' ?>\n")
-        backup_temp.write(b"\n")
-        backup_temp.write(bytes(f'<calls count="{str(numcalls)}">\n', encoding="utf8"))
-        with open(filename, "rb") as backup_file:
-            copyfileobj(backup_file, backup_temp)
-    # Overwrite output file with temp file
-    move(backup_temp.name, filename)
-
-main()
\ No newline at end of file
+CONVERSATION_PARSERS = {"lxml": parse_conversation_lxml, "html.parser": parse_conversation}
+CALL_PARSERS = {"lxml": parse_call_lxml, "html.parser": parse_call}
+
+# SMS output. With a size or message limit it is split into numbered part files, each a complete backup with its
+# own header. Parts only roll over between conversations, so a conversation is never split across two files.
+def new_sms_output(sms_log_filename, split_bytes, split_messages, buffer_size, fsync_policy, compression="none"):
+    sms_output = {
+        "filename": sms_log_filename,
+        "compression": compression,
+        "split_bytes": split_bytes,
+        "split_messages": split_messages,
+        "buffer_size": buffer_size,
+        "fsync_policy": fsync_policy,
+        "with_header": False,
+        "parts": [],
+        "bytes_written": 0,
+    }
+    open_sms_part(sms_output)
+    return sms_output
+
+def get_sms_part_filename(sms_output, part_number):
+    suffix = COMPRESSION_SUFFIXES[sms_output["compression"]]
+    if not (sms_output["split_bytes"] or sms_output["split_messages"]):
+        return sms_output["filename"] + suffix
+    root, ext = os.path.splitext(sms_output["filename"])
+    return f"{root}-{part_number}{ext}{suffix}"
+
+def open_sms_part(sms_output):
+    part_filename = get_sms_part_filename(sms_output, len(sms_output["parts"]) + 1)
+    sms_output["parts"].append(part_filename)
+    sms_output["sink"] = OutputSink(part_filename, sms_output["buffer_size"], sms_output["fsync_policy"],
+                                    sms_output["compression"])
+    sms_output["num_sms"] = 0
+    sms_output["body_start"] = 0
+    if sms_output["with_header"]:
+        start_sms_header(sms_output)
+
+def start_sms_header(sms_output):
+    sms_output["with_header"] = True
+    sms_output["header_offset"] = write_sms_header(sms_output["sink"])
+    sms_output["body_start"] = sms_output["sink"].bytes_written
+
+def finish_sms_part(sms_output):
+    sms_sink = sms_output["sink"]
+    if sms_output["with_header"]:
+        sms_sink.write("</smses>")
+    sms_sink.close()
+    sms_output["bytes_written"] += sms_sink.bytes_written
+    if sms_output["with_header"]:
+        sms_sink.patch(sms_output["header_offset"], format_sms_header(sms_output["num_sms"]))
+
+# Function to move on to a new part file before a conversation if the current part is full, returning the sink
+# the conversation should be written to
+def roll_sms_part(sms_output, conversation):
+    num_messages = len(conversation["messages"]) if sms_output["with_header"] else 0
+    sms_sink = sms_output["sink"]
+    part_is_full = (
+        (sms_output["split_bytes"] and sms_sink.bytes_written >= sms_output["split_bytes"]) or
+        (sms_output["split_messages"] and sms_output["num_sms"] + num_messages > sms_output["split_messages"])
+    )
+    if part_is_full and sms_sink.bytes_written > sms_output["body_start"]:
+        finish_sms_part(sms_output)
+        open_sms_part(sms_output)
+        print("New SMS file will be saved to " + sms_output["sink"].path)
+    sms_output["num_sms"] += num_messages
+    return sms_output["sink"]
+
+# Function to finish the last part, and remove higher numbered parts left over from an earlier run
+def close_sms_output(sms_output):
+    finish_sms_part(sms_output)
+    part_number = len(sms_output["parts"]) + 1
+    while (sms_output["split_bytes"] or sms_output["split_messages"]) and \
+            os.path.exists(get_sms_part_filename(sms_output, part_number)):
+        os.remove(get_sms_part_filename(sms_output, part_number))
+        part_number += 1
+
+# The count is not known until the end of the run, so the header reserves a fixed-width count field that is
+# padded with spaces before the closing ">". The functions return the offset of the header, which is patched with
+# the final count once the file is closed.
+def write_sms_header(sms_sink):
+    return sms_sink.reserve(format_sms_header(0))
+
+def write_calls_header(call_sink):
+    return call_sink.reserve(format_calls_header(0))
+
+def format_sms_header(count):
+    return "<?xml version='1.0' encoding='UTF-8' standalone='yes' ?>\n\n" + '<smses count="' + \
+        format_header_count(count) + ">\n"
+
+def format_calls_header(count):
+    return "<?xml version='1.0' encoding='UTF-8' standalone='yes' ?>\n\n" + '<calls count="' + \
+        format_header_count(count) + ">\n"
+
+# Function to format the count attribute value and its closing quote, padded to the reserved width
+def format_header_count(count):
+    return f'{count}"'.ljust(HEADER_COUNT_WIDTH)
+
+if __name__ == "__main__":
+    main()
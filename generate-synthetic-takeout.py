@@ -0,0 +1,176 @@
+import argparse
+import random
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+# Generates a Google Voice Takeout folder with made-up conversations, calls and attachments, laid out and named the way
+# Takeout does it, so conversions can be benchmarked and compared on any machine without a real export.
+
+OWN_NUMBER = "+15550001111"
+CONTACT_NAMES = ["Alice Jones", "Bob Smith", "Carol", "Dave O'Brien", "A Very Long Contact Name For Truncation Tests"]
+MESSAGE_TEXTS = ["Hello &amp; welcome", "line one<br>line two", "She said &quot;hi&quot;, it's ok", "On my way",
+                 "MMS Sent", "Emoji ☺ test", "See you at 7?"]
+CALL_KINDS = ["Placed", "Received", "Missed", "Voicemail"]
+IMAGE_EXTENSIONS = [".jpg", ".png", ".gif"]
+TAKEOUT_FILENAME_LENGTH = 50  # Takeout truncates attachment names to this many characters
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic Google Voice Takeout folder for benchmarks")
+    parser.add_argument("output", help="folder to create the Takeout folder in")
+    parser.add_argument("--conversations", type=int, default=1000, help="number of text conversations")
+    parser.add_argument("--messages", type=int, default=20, help="messages in each conversation")
+    parser.add_argument("--group-percent", type=int, default=10, help="share of conversations that are group chats")
+    parser.add_argument("--group-size", type=int, default=4, help="most participants in a group chat, besides the owner")
+    parser.add_argument("--named-percent", type=int, default=30,
+                        help="share of conversations whose files are named after a contact instead of a number")
+    parser.add_argument("--calls", type=int, default=2, help="most call files for each contact")
+    parser.add_argument("--attachment-percent", type=int, default=5, help="share of messages with an attachment")
+    parser.add_argument("--duplicate-percent", type=int, default=20,
+                        help="share of attachments that repeat the name of an earlier one, giving (n)-suffixed files")
+    parser.add_argument("--media-kb", type=int, default=64, help="average size of an image or video attachment")
+    parser.add_argument("--seed", type=int, default=1, help="random seed, the same options and seed give the same tree")
+    args = parser.parse_args()
+
+    settings = vars(args).copy()
+    calls_dir = Path(settings.pop("output"), "Takeout", "Voice", "Calls")
+    calls_dir.mkdir(parents=True, exist_ok=True)
+    Path(calls_dir.parent, "Phones.vcf").write_text(f"BEGIN:VCARD\nFN:Me\nTEL:{OWN_NUMBER}\nEND:VCARD\n")
+    counts = generate_takeout(calls_dir, settings)
+    print(f"Generated {counts['conversations']} conversations with {counts['messages']} messages, "
+          f"{counts['calls']} calls and {counts['attachments']} attachments in {calls_dir}")
+
+# Function to write every conversation, call and attachment file into the Calls folder, returning what was written
+def generate_takeout(calls_dir, settings):
+    rnd = random.Random(settings["seed"])
+    state = {
+        "calls_dir": calls_dir,
+        "rnd": rnd,
+        "settings": settings,
+        "filenames": set(),
+        "counts": Counter(conversations=0, messages=0, calls=0, attachments=0),
+    }
+    start = datetime(2020, 1, 1, 12, 0, 0, tzinfo=timezone.utc)
+    for conversation_index in range(settings["conversations"]):
+        started = start + timedelta(hours=conversation_index * 7, seconds=rnd.randint(0, 9999))
+        contact = (f"+1555{rnd.randint(1000000, 9999999)}", f"{rnd.choice(CONTACT_NAMES)} {conversation_index}")
+        if rnd.randrange(100) < settings["group_percent"]:
+            others = [(f"+1555{rnd.randint(1000000, 9999999)}", f"Member {member_index}")
+                      for member_index in range(rnd.randint(1, max(1, settings["group_size"] - 1)))]
+            generate_conversation(state, f"Group Conversation - {format_filename_time(started)}", started,
+                                  [contact, *others], is_group=True)
+            continue
+        is_named = rnd.randrange(100) < settings["named_percent"]
+        title_name = contact[1] if is_named else contact[0]
+        only_me = generate_conversation(state, f"{title_name} - Text - {format_filename_time(started)}", started,
+                                        [contact])
+        # A contact-named thread with only the owner's messages gets its number from a Placed call
+        call_kinds = ["Placed"] if is_named and only_me else []
+        call_kinds += [rnd.choice(CALL_KINDS) for _ in range(rnd.randint(0, settings["calls"]))]
+        for call_kind in call_kinds:
+            generate_call(state, title_name, contact, call_kind, started + timedelta(minutes=rnd.randint(1, 5000)))
+    return state["counts"]
+
+# Function to write one message thread, returning whether every message in it was sent by the owner
+def generate_conversation(state, title, started, participants, is_group=False):
+    rnd = state["rnd"]
+    settings = state["settings"]
+    parts = ['<html><head><title>Conversation</title></head><body><div class="hChatLog hfeed">']
+    if is_group:
+        parts.append('<div class="participants">Group conversation with:\n'
+                     + ", ".join(format_sender(*participant) for participant in participants) + "</div>")
+    only_me = not is_group and rnd.random() < 0.1
+    stems = {}  # image name stem -> extension
+    for message_index in range(settings["messages"]):
+        sent = started + timedelta(minutes=message_index * 3, milliseconds=rnd.randint(0, 999))
+        is_me = only_me or rnd.random() < 0.4
+        number, name = rnd.choice(participants)
+        sender = format_sender(OWN_NUMBER, "Me", is_me=True) if is_me else format_sender(number, name)
+        attachment = ""
+        if rnd.randrange(100) < settings["attachment_percent"]:
+            attachment = generate_attachment(state, title, message_index, stems)
+        parts.append(f'<div class="message"><abbr class="dt" title="{format_message_time(sent)}">'
+                     f'{sent:%b %d, %Y}</abbr>:\n{sender}:\n<q>{rnd.choice(MESSAGE_TEXTS)}</q>\n{attachment}</div>')
+    parts.append("</div></body></html>")
+    write_file(state, f"{title}.html", "\n".join(parts).encode("utf8"))
+    state["counts"]["conversations"] += 1
+    state["counts"]["messages"] += settings["messages"]
+    return only_me
+
+# Function to write an attachment file and return the markup that refers to it. Takeout names attachments after the
+# conversation, truncated, and adds (1), (2), ... when a name is taken, which --duplicate-percent reproduces by
+# reusing an earlier image name of the same conversation.
+def generate_attachment(state, title, message_index, stems):
+    rnd = state["rnd"]
+    settings = state["settings"]
+    kind = rnd.choices(["image", "video", "vcard"], weights=[8, 1, 1])[0]
+    extension = rnd.choice(IMAGE_EXTENSIONS)
+    if kind == "image" and stems and rnd.randrange(100) < settings["duplicate_percent"]:
+        stem = rnd.choice(list(stems))
+        extension = stems[stem]
+    else:
+        stem = f"{title}-{message_index}"[:TAKEOUT_FILENAME_LENGTH]
+        # Long titles truncate to the same stem, which only stays unambiguous for images
+        if len(title) + 2 >= TAKEOUT_FILENAME_LENGTH:
+            kind = "image"
+    media_size = settings["media_kb"] * 1024
+    if kind == "image":
+        stems[stem] = extension
+        write_file(state, unused_attachment_name(state, stem, extension),
+                   rnd.randbytes(rnd.randint(media_size // 2, media_size * 3 // 2)))
+        markup = f'<div><img src="{stem}" alt="Image MMS Attachment" /></div>'
+    elif kind == "video":
+        write_file(state, unused_attachment_name(state, stem, ".mp4"),
+                   rnd.randbytes(rnd.randint(media_size, media_size * 4)))
+        markup = f'<div><a class="video" href="{stem}">Video MMS Attachment</a></div>'
+    else:
+        vcard = f"BEGIN:VCARD\nFN:Friend {message_index}\nTEL:+1555{rnd.randint(1000000, 9999999)}\nEND:VCARD\n"
+        write_file(state, unused_attachment_name(state, stem, ".vcf"), vcard.encode("utf8"))
+        markup = f'<div><a class="vcard" href="{stem}">Contact card attachment</a></div>'
+    state["counts"]["attachments"] += 1
+    return markup
+
+def unused_attachment_name(state, stem, extension):
+    filename = stem + extension
+    copy_number = 0
+    while filename in state["filenames"]:
+        copy_number += 1
+        filename = f"{stem}({copy_number}){extension}"
+    return filename
+
+def generate_call(state, title_name, contact, call_kind, called):
+    rnd = state["rnd"]
+    number, name = contact
+    duration = "" if call_kind == "Missed" else \
+        f'<abbr class="duration" title="PT{rnd.randint(0, 59)}M{rnd.randint(0, 59)}S">(00:00:00)</abbr>'
+    markup = (
+        '<html><head><title>Call</title></head><body><div class="haudio"><span class="fn">Call</span>'
+        f'<div class="contributor vcard">{call_kind} call from <a class="tel" href="tel:{number}">'
+        f'<span class="fn">{name}</span></a></div>'
+        f'<abbr class="published" title="{format_message_time(called)}">{called:%b %d, %Y}</abbr>{duration}'
+        f'<div class="tags">Labels: <a rel="tag" href="http://www.google.com/voice#{call_kind.lower()}">'
+        f'{call_kind}</a></div></div></body></html>'
+    )
+    write_file(state, f"{title_name} - {call_kind} - {format_filename_time(called)}.html", markup.encode("utf8"))
+    state["counts"]["calls"] += 1
+
+def write_file(state, filename, data):
+    state["filenames"].add(filename)
+    Path(state["calls_dir"], filename).write_bytes(data)
+
+# Takeout file names carry the UTC time, message and call times carry the local time with its offset
+def format_filename_time(moment):
+    return moment.strftime("%Y-%m-%dT%H_%M_%SZ")
+
+def format_message_time(moment):
+    local = moment.astimezone(timezone(timedelta(hours=-5)))
+    return local.strftime("%Y-%m-%dT%H:%M:%S.") + f"{local.microsecond // 1000:03d}-05:00"
+
+def format_sender(number, name, is_me=False):
+    if is_me:
+        return (f'<cite class="sender vcard"><a class="tel" href="tel:{number}">'
+                f'<abbr class="fn" title="">Me</abbr></a></cite>')
+    return f'<cite class="sender vcard"><a class="tel" href="tel:{number}"><span class="fn">{name}</span></a></cite>'
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+import importlib
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+# The converter and the generator are scripts with dashes in their names, so they are imported with importlib and run
+# by path. The tests share one Takeout folder: a small synthetic one from generate-synthetic-takeout.py plus the
+# hand-written files in data/, which hold the corner cases the generator doesn't make.
+
+SCRIPT_DIR = Path(__file__).resolve().parent.parent
+DATA_DIR = Path(__file__).resolve().parent / "data"
+CONVERTER = SCRIPT_DIR / "export-gvoice-takeout.py"
+GENERATOR = SCRIPT_DIR / "generate-synthetic-takeout.py"
+GENERATOR_ARGS = ["--conversations", "40", "--messages", "6", "--group-percent", "20", "--named-percent", "40",
+                  "--attachment-percent", "20", "--media-kb", "2"]
+
+sys.path.insert(0, str(SCRIPT_DIR))
+
+@pytest.fixture(scope="session")
+def converter():
+    return importlib.import_module("export-gvoice-takeout")
+
+@pytest.fixture(scope="session")
+def takeout_dir(tmp_path_factory):
+    takeout_dir = tmp_path_factory.mktemp("takeout")
+    subprocess.run([sys.executable, str(GENERATOR), str(takeout_dir), *GENERATOR_ARGS], check=True,
+                   stdout=subprocess.DEVNULL)
+    for data_file in DATA_DIR.iterdir():
+        shutil.copy(data_file, takeout_dir / "Takeout" / "Voice" / "Calls")
+    return takeout_dir
+
+# Fixture to convert a Takeout folder unattended into sms.xml and calls.xml in a new output folder
+@pytest.fixture
+def convert():
+    def convert(input_path, output_dir, *options):
+        output_dir.mkdir(parents=True)
+        subprocess.run([sys.executable, str(CONVERTER), "--input", str(input_path), "--process", "both",
+                        "--cleanup", "keep", "--sms-output", "sms.xml", "--calls-output", "calls.xml", *options],
+                       cwd=output_dir, check=True, stdout=subprocess.DEVNULL)
+        return output_dir
+    return convert
@@ -0,0 +1,21 @@
+import gzip
+import re
+
+# --merge converts a Takeout in the same process and keeps every message and call of overlapping exports once
+
+def split_output(xml):
+    declaration, blank, header, body = xml.split(b"\n", 3)
+    return int(re.search(rb'count="(\d+)"', header).group(1)), body
+
+def test_merging_a_takeout_with_its_own_output_skips_duplicates(converter, convert, takeout_dir, tmp_path):
+    output_dir = convert(takeout_dir, tmp_path / "converted")
+    merged_dir = tmp_path / "merged"
+    merged_dir.mkdir()
+    converter.main(["--merge", str(takeout_dir), str(output_dir / "sms.xml"), str(output_dir / "calls.xml"),
+                    "--sms-output", str(merged_dir / "sms.xml"), "--calls-output", str(merged_dir / "calls.xml"),
+                    "--compress", "gzip"])
+    for filename, record_pattern in (("sms.xml", rb"^<(?:sms|mms) "), ("calls.xml", rb"^<call ")):
+        with gzip.open(merged_dir / (filename + ".gz")) as merged_file:
+            count, body = split_output(merged_file.read())
+        assert body == split_output((output_dir / filename).read_bytes())[1], filename
+        assert count == len(re.findall(record_pattern, body, re.MULTILINE)) > 0, filename
@@ -0,0 +1,23 @@
+import re
+import shutil
+
+# --sort-by-date sorts the records of an output stably by date, also when it takes many runs and merge passes
+
+def get_records(converter, filename):
+    data = filename.read_bytes()
+    with open(filename, "rb") as output_file:
+        return [data[start:end] for start, end, key_hash in converter.iter_output_records(output_file)]
+
+def get_date(record):
+    return int(re.search(rb' date="(\d+)"', record).group(1))
+
+def test_sorting_in_many_runs_is_a_stable_sort(converter, convert, takeout_dir, tmp_path):
+    output_dir = convert(takeout_dir, tmp_path / "converted")
+    for filename in ("sms.xml", "calls.xml"):
+        sorted_filename = tmp_path / filename
+        shutil.copy(output_dir / filename, sorted_filename)
+        # Runs of a few hundred bytes give more runs than are merged at once
+        converter.sort_output_file(str(sorted_filename), 300, 4096, "none", "none")
+        records = get_records(converter, output_dir / filename)
+        assert get_records(converter, sorted_filename) == sorted(records, key=get_date), filename
+        assert sorted_filename.stat().st_size == (output_dir / filename).stat().st_size, filename